@@ -0,0 +1,179 @@
+import os
+import threading
+import time
+from flask import g, request
+from werkzeug.exceptions import ServiceUnavailable
+
+from metrics.metrics import observe_admission_wait, observe_shed
+
+'''
+Admission control
+    requests are sorted into route classes (read, write, export), each
+    with its own number of requests served at once by the process. Above
+    it, a request waits in a bounded queue for at most ADMISSION_TIMEOUT
+    seconds; when the queue is full or the wait times out, it is rejected
+    at once with a 503 and a Retry-After header, before authentication or
+    any query. A slow class then fills its own slots and queue, and the
+    others keep being served
+
+    the limits matter for workers that serve requests concurrently
+    (threads, gevent). A sync worker serves one request at a time, queued
+    in front of it by the server: with ADMISSION_MAX_REQUEST_AGE, requests
+    whose X-Request-Start header (set by the Heroku router, or nginx) is
+    older than that many seconds are shed instead of served after their
+    client gave up
+
+    ADMISSION_LIMITS     slots per class, e.g. read=32,write=8,export=2
+                         (empty: no admission control)
+    ADMISSION_QUEUE      waiting requests per class, e.g. read=64,write=16
+    ADMISSION_TIMEOUT    seconds a request may wait for a slot (default 2)
+    ADMISSION_RETRY_AFTER  Retry-After of the 503, in seconds (default 1)
+'''
+ROUTE_CLASSES = ['read', 'write', 'export']
+SAFE_METHODS = ['GET', 'HEAD']
+
+
+def _per_class(value):
+    classes = {}
+    for item in (value or '').split(','):
+        if not item.strip():
+            continue
+        route_class, number = item.split('=')
+        if route_class.strip() not in ROUTE_CLASSES:
+            raise ValueError(f'Unknown route class: {route_class}')
+        classes[route_class.strip()] = int(number)
+    return classes
+
+
+ADMISSION_LIMITS = _per_class(
+    os.getenv('ADMISSION_LIMITS', 'read=32,write=8,export=2'))
+ADMISSION_QUEUE = _per_class(
+    os.getenv('ADMISSION_QUEUE', 'read=64,write=16,export=2'))
+ADMISSION_TIMEOUT = float(os.getenv('ADMISSION_TIMEOUT', 2))
+ADMISSION_RETRY_AFTER = int(os.getenv('ADMISSION_RETRY_AFTER', 1))
+ADMISSION_MAX_REQUEST_AGE = float(os.getenv('ADMISSION_MAX_REQUEST_AGE', 0))
+
+
+class Overloaded(Exception):
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+'''
+AdmissionLimiter
+    `limit` slots and a queue of `queue_size` waiting requests. acquire()
+    returns the seconds waited for a slot, or raises Overloaded
+    ('queue_full' or 'timeout'); every acquire() is paired with a
+    release()
+'''
+
+
+class AdmissionLimiter:
+    def __init__(self, limit, queue_size=0, timeout=ADMISSION_TIMEOUT,
+                 clock=time.monotonic):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.clock = clock
+
+        self.active = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            if self.active < self.limit:
+                self.active += 1
+                return 0.0
+            if self.waiting >= self.queue_size:
+                raise Overloaded('queue_full')
+
+            started = self.clock()
+            deadline = started + self.timeout
+            self.waiting += 1
+            try:
+                while self.active >= self.limit:
+                    remaining = deadline - self.clock()
+                    if remaining <= 0:
+                        raise Overloaded('timeout')
+                    self._condition.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.active += 1
+            return self.clock() - started
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+
+def limiters_from_env():
+    return {route_class: AdmissionLimiter(limit,
+                                          ADMISSION_QUEUE.get(route_class, 0))
+            for route_class, limit in ADMISSION_LIMITS.items()}
+
+
+def request_class(endpoint_classes):
+    # The class of an endpoint can be overridden (None: not limited);
+    # otherwise reads are the safe methods, and CORS preflights are free
+    if request.endpoint in endpoint_classes:
+        return endpoint_classes[request.endpoint]
+    if request.method == 'OPTIONS':
+        return None
+    return 'read' if request.method in SAFE_METHODS else 'write'
+
+
+def request_age():
+    # X-Request-Start: milliseconds (Heroku) or `t=` microseconds (nginx)
+    value = request.headers.get('X-Request-Start', '')
+    try:
+        if value.startswith('t='):
+            started = int(value[2:]) / 1e6
+        else:
+            started = int(value) / 1e3
+    except ValueError:
+        return None
+    return time.time() - started
+
+
+def init_admission(app, endpoint_classes=None, limiters=None,
+                   max_request_age=ADMISSION_MAX_REQUEST_AGE):
+    endpoint_classes = endpoint_classes or {}
+    if limiters is None:
+        limiters = limiters_from_env()
+    if not limiters and not max_request_age:
+        return
+
+    def shed(route_class, reason):
+        observe_shed(route_class, reason)
+        raise ServiceUnavailable(retry_after=ADMISSION_RETRY_AFTER)
+
+    @app.before_request
+    def admit_request():
+        route_class = request_class(endpoint_classes)
+        if route_class is None:
+            return
+
+        if max_request_age:
+            age = request_age()
+            if age is not None and age > max_request_age:
+                shed(route_class, 'expired')
+
+        limiter = limiters.get(route_class)
+        if limiter is None:
+            return
+        try:
+            waited = limiter.acquire()
+        except Overloaded as error:
+            shed(route_class, error.reason)
+        g.admission_limiter = limiter
+        observe_admission_wait(route_class, waited)
+
+    @app.teardown_request
+    def release_request(error):
+        # After a streamed body has been sent (stream_with_context)
+        limiter = g.pop('admission_limiter', None)
+        if limiter is not None:
+            limiter.release()
@@ -1,21 +1,753 @@
 import os
-from flask import Flask, request, jsonify, abort
-from sqlalchemy import exc
+import base64
+import binascii
+from datetime import date
+from flask import Flask, Response, request, jsonify, abort, \
+    stream_with_context
+from flask import json as flask_json
+from sqlalchemy import exc, select, tuple_
 import json
 from flask_cors import CORS
 
-from models.models import setup_db, Actor, Movie
-from auth.auth import AuthError, requires_auth
+from dateutil import parser as date_parser
+
+from models.models import setup_db, db, bulk_write, cast_names, \
+    filmography_titles, make_etag, actor_ids_of_movies, movie_ids_of_actors, \
+    get_row_count, query_fieldset, existing_ids, add_links, remove_links, \
+    movies_actors, Actor, Movie
+from models.search import ranked_ids
+from models.pool import pool_status
+from models.costars import COSTAR_INDEX, COSTAR_MAX_DEPTH, costar_index, \
+    costars_sql, shortest_path_sql
+from auth.auth import AuthError, requires_auth, check_permissions
+from cache.cache import response_cache, movie_key, actor_key
+from metrics.metrics import init_metrics, metrics_response
+from metrics.profiling import init_profiling
+from admission.admission import init_admission
+from serialization.encoders import encoder_from_env
+from serialization.compression import init_compression
 
 
 MOVIES_PER_PAGE = int(os.getenv('MOVIES_PER_PAGE'))
 ACTORS_PER_PAGE = int(os.getenv('ACTORS_PER_PAGE'))
+# Upper bound for the `limit` of cursor (keyset) pagination
+MOVIES_MAX_LIMIT = int(os.getenv('MOVIES_MAX_LIMIT', 100))
+ACTORS_MAX_LIMIT = int(os.getenv('ACTORS_MAX_LIMIT', 100))
 GENDERS = ['male', 'female']
+# Maximum number of rows accepted by the bulk routes, and rows per INSERT
+BULK_MAX_ROWS = int(os.getenv('BULK_MAX_ROWS', 10000))
+BULK_CHUNK_SIZE = int(os.getenv('BULK_CHUNK_SIZE', 1000))
+# Largest id of the INTEGER primary keys
+MAX_ID = 2 ** 31 - 1
+# Rows fetched from the server-side cursor per batch by the export routes
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
+# Maximum number of ids of a batch fetch
+BATCH_MAX_IDS = int(os.getenv('BATCH_MAX_IDS', 1000))
+
+
+'''
+Keyset (cursor) pagination
+    `?after=<cursor>&limit=N` seeks past the last row of the previous page
+    on the ordering columns instead of using OFFSET, and does not COUNT(*).
+    The cursor is an opaque, URL-safe encoding of the ordering values of
+    the last row returned
+'''
+
+
+def encode_cursor(values):
+    raw = json.dumps(values, separators=(',', ':'),
+                     default=lambda value: value.isoformat()).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, size):
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(cursor + padding))
+    except (binascii.Error, ValueError):
+        abort(400)
+
+    if not isinstance(values, list) or len(values) != size:
+        abort(400)
+    return values
+
+
+def wants_keyset_pagination():
+    return 'after' in request.args or 'limit' in request.args
+
+
+def get_limit(default, maximum):
+    try:
+        limit = int(request.args.get('limit', default))
+    except ValueError:
+        abort(400)
+    return max(1, min(limit, maximum))
+
+
+def cursor_value(column, value):
+    # Dates are encoded as ISO strings in the cursor; any other value must
+    # have the type of its column
+    python_type = column.type.python_type
+    if python_type is date:
+        try:
+            return date.fromisoformat(value)
+        except (TypeError, ValueError):
+            abort(400)
+    if not isinstance(value, python_type) or isinstance(value, bool):
+        abort(400)
+    return value
+
+
+def ordering(columns, descending):
+    return [column.desc() if descending else column for column in columns]
+
+
+def paginate_keyset(query, columns, default_limit, max_limit,
+                    descending=False, keys=None):
+    # keys: the attributes of the rows holding the values of `columns`
+    if keys is None:
+        keys = [column.key for column in columns]
+    limit = get_limit(default_limit, max_limit)
+
+    after = request.args.get('after')
+    if after:
+        values = [cursor_value(column, value) for column, value
+                  in zip(columns, decode_cursor(after, len(columns)))]
+        if descending:
+            query = query.filter(tuple_(*columns) < tuple_(*values))
+        else:
+            query = query.filter(tuple_(*columns) > tuple_(*values))
+
+    rows = query.order_by(*ordering(columns, descending)) \
+        .limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor([getattr(last, key) for key in keys])
+
+    return rows, next_cursor
+
+
+'''
+Filtering and sorting
+    `?sort=<key>` (or `-<key>` for descending order) orders the list routes
+    by one of the keys of MOVIE_SORTS / ACTOR_SORTS, with the id as a
+    tie-breaker so that cursors stay stable. Every filter and sort key is
+    backed by an index (see the models)
+'''
+MOVIE_SORTS = {
+    'id': Movie.id,
+    'title': Movie.title,
+    'release_date': Movie.release_date
+}
+ACTOR_SORTS = {
+    'id': Actor.id,
+    'name': Actor.name,
+    'age': Actor.age
+}
+
+
+def get_sort(sorts, id_column):
+    sort = request.args.get('sort', 'id')
+    descending = sort.startswith('-')
+    column = sorts.get(sort.lstrip('-'))
+    if column is None:
+        abort(400)
+
+    if column is id_column:
+        return [id_column], descending
+    return [column, id_column], descending
+
+
+def get_date_arg(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        abort(400)
+
+
+def get_int_arg(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        abort(400)
+
+
+def filter_movies(query):
+    released_from = get_date_arg('release_date_from')
+    released_to = get_date_arg('release_date_to')
+
+    if released_from is not None:
+        query = query.filter(Movie.release_date >= released_from)
+    if released_to is not None:
+        query = query.filter(Movie.release_date <= released_to)
+    return query
+
+
+def filter_actors(query):
+    min_age = get_int_arg('min_age')
+    max_age = get_int_arg('max_age')
+    gender = request.args.get('gender')
+
+    if min_age is not None:
+        query = query.filter(Actor.age >= min_age)
+    if max_age is not None:
+        query = query.filter(Actor.age <= max_age)
+    if gender is not None:
+        if gender not in GENDERS:
+            abort(400)
+        query = query.filter(Actor.gender == gender)
+    return query
+
+
+'''
+Totals
+    `?total=true` adds the number of matching rows to the list responses.
+    Without filters, it is read from the maintained row counter (see
+    models.row_counts); with filters, it is a COUNT(*) of the filtered query
+'''
+
+
+def list_total(query, table_name):
+    if request.args.get('total', '').lower() not in ['1', 'true']:
+        return None
+    if query.whereclause is None:
+        return get_row_count(table_name)
+    return query.order_by(None).count()
+
+
+def with_total(body, total):
+    if total is not None:
+        body['total'] = total
+    return body
+
+
+'''
+Sparse fieldsets
+    `?fields=id,title` returns, and loads, only these columns of the rows;
+    `?include=actors` adds their relationships. With `fields` and without
+    `include`, no relationship is loaded (one can also be named in
+    `fields`). Without either, the rows are returned in full
+'''
+
+
+def get_names(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    return [item for item in value.split(',') if item]
+
+
+def get_fieldset(model):
+    fields = get_names('fields')
+    include = get_names('include')
+
+    if fields is not None:
+        include = (include or []) + [
+            field for field in fields if field in model.relationships]
+        fields = [field for field in fields
+                  if field not in model.relationships]
+        if any(field not in model.fields for field in fields):
+            abort(400)
+        fields = list(dict.fromkeys(fields))
+    elif include is None:
+        include = model.relationships
+
+    if any(name not in model.relationships for name in include):
+        abort(400)
+    return fields, list(dict.fromkeys(include))
+
+
+def is_full_fieldset(model, fields, include):
+    return fields is None and include == model.relationships
+
+
+'''
+Batch fetch
+    `GET /movies?ids=1,2,3`, or `POST /movies/batch` with {"ids": [...]}
+    for long lists, returns the rows in the order of the ids, read with one
+    IN query (and one per included relationship); unknown ids are listed in
+    `missing`. Sparse fieldsets apply, filters and pagination do not
+'''
+
+
+def parse_ids(values):
+    if not isinstance(values, list):
+        abort(400)
+    if len(values) > BATCH_MAX_IDS:
+        abort(413)
+
+    ids = []
+    for value in values:
+        if isinstance(value, bool) or not isinstance(value, (int, str)):
+            abort(400)
+        try:
+            ids.append(int(value))
+        except ValueError:
+            abort(400)
+    return list(dict.fromkeys(ids))
+
+
+def fetch_batch(model, key, ids):
+    fields, include = get_fieldset(model)
+    rows = []
+    if ids:
+        rows = query_fieldset(model, fields, include).filter(
+            model.id.in_(ids)).all()
+    rows_by_id = {row.id: row for row in rows}
+    found = [rows_by_id[id] for id in ids if id in rows_by_id]
+    missing = [id for id in ids if id not in rows_by_id]
+
+    return conditional_response(
+        make_etag(list_etag(found, None, fields, include), missing),
+        lambda: {
+            'success': True,
+            key: [row.format(fields, include) for row in found],
+            'missing': missing
+        })
+
+
+'''
+Bulk validation
+    the same rules as post_movie / post_actor, applied to each row. They
+    return the row to write, or raise ValueError with the reason
+'''
+
+
+def validate_id(item):
+    if 'id' not in item:
+        return {}
+    if not isinstance(item['id'], int) or isinstance(item['id'], bool) \
+            or not 1 <= item['id'] <= MAX_ID:
+        raise ValueError(f'id must be an integer from 1 to {MAX_ID}')
+    return {'id': item['id']}
+
+
+def validate_movie(item):
+    if not isinstance(item, dict):
+        raise ValueError('a movie must be an object')
+
+    title = item.get('title', None)
+    release_date = item.get('release_date', None)
+
+    if title is None or release_date is None:
+        raise ValueError('title and release_date are required')
+    if not isinstance(title, str):
+        raise ValueError('title must be a string')
+    try:
+        release_date = date_parser.parse(str(release_date)).date()
+    except (ValueError, OverflowError):
+        raise ValueError('release_date is not a valid date')
+
+    return dict(validate_id(item), title=title, release_date=release_date)
+
+
+def validate_actor(item):
+    if not isinstance(item, dict):
+        raise ValueError('an actor must be an object')
+
+    name = item.get('name', None)
+    age = item.get('age', None)
+    gender = item.get('gender', None)
+
+    if name is None or age is None or gender is None:
+        raise ValueError('name, age and gender are required')
+    if not isinstance(name, str):
+        raise ValueError('name must be a string')
+    if not isinstance(age, int) or isinstance(age, bool):
+        raise ValueError('age must be an integer')
+    if gender not in GENDERS:
+        raise ValueError('gender must be one of ' + ', '.join(GENDERS))
+
+    return dict(validate_id(item), name=name, age=age, gender=gender)
+
+
+def bulk_create(payload, model, key, validate, invalidate):
+    body = request.get_json()
+
+    # Either a bare array, or {"<key>": [...], "upsert": true}
+    upsert = False
+    if isinstance(body, dict):
+        upsert = body.get('upsert', False) is True
+        body = body.get(key, None)
+
+    if not isinstance(body, list) or len(body) == 0:
+        abort(400)
+    if len(body) > BULK_MAX_ROWS:
+        abort(413)
+
+    # Replacing existing rows also requires the update permission
+    if upsert:
+        check_permissions('patch:' + key, payload)
+
+    rows = []
+    errors = []
+    seen_ids = set()
+    for index, item in enumerate(body):
+        try:
+            row = validate(item)
+            if 'id' in row:
+                if not upsert:
+                    raise ValueError('id is only accepted with upsert')
+                if row['id'] in seen_ids:
+                    raise ValueError('duplicate id in the batch')
+                seen_ids.add(row['id'])
+            rows.append(row)
+        except ValueError as error:
+            errors.append({'index': index, 'message': str(error)})
+
+    if rows:
+        try:
+            bulk_write(model, rows, upsert=upsert,
+                       chunk_size=BULK_CHUNK_SIZE)
+            db.session.commit()
+        except exc.SQLAlchemyError:
+            db.session.rollback()
+            abort(422)
+
+        if seen_ids:
+            invalidate(list(seen_ids))
+
+    return jsonify({
+        'success': True,
+        'written': len(rows),
+        'errors': errors
+    })
+
+
+'''
+NDJSON export
+    streams a whole table, one JSON object per line. Rows are read through
+    a server-side cursor, EXPORT_BATCH_SIZE at a time, and the associations
+    of each batch are fetched with one query, so memory stays flat
+    whatever the size of the table
+'''
+
+
+def export_ndjson(columns, related_key, load_related):
+    def generate():
+        connection = db.engine.connect().execution_options(
+            stream_results=True)
+        try:
+            result = connection.execute(
+                select(columns).order_by(columns[0]))
+            while True:
+                rows = result.fetchmany(EXPORT_BATCH_SIZE)
+                if not rows:
+                    break
+
+                related = load_related(connection, [row.id for row in rows])
+                lines = []
+                for row in rows:
+                    item = dict(row)
+                    item[related_key] = related[row.id]
+                    lines.append(flask_json.dumps(item))
+                yield '\n'.join(lines) + '\n'
+        finally:
+            connection.close()
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson')
+
+
+'''
+Conditional requests
+    responses carry a strong ETag computed from the row versions (see
+    Movie.etag / Actor.etag). A matching If-None-Match is answered with a
+    304 before the body is serialized, and writes fail with a 412 when
+    If-Match does not match the current representation
+'''
+
+
+def conditional_response(etag, build_body):
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(build_body())
+    response.set_etag(etag)
+    return response
+
+
+def list_etag(rows, total=None, fields=None, include=()):
+    return make_etag([row.etag(fields, include) for row in rows], total)
+
+
+def check_if_match(row):
+    if request.if_match and not request.if_match.contains(row.etag()):
+        abort(412)
+
+
+'''
+Response cache
+    single Movies and Actors are served from the response cache when
+    possible. `load` runs on a miss and returns the ETag and the body; the
+    write routes invalidate the changed row and the rows on the other side
+    of movies_actors, whose format() includes its title or name
+'''
+
+
+def cached_resource(key, load):
+    entry = response_cache.get(key)
+    if entry is None:
+        # Read before the row, so that a write meanwhile drops the fill
+        generation = response_cache.generation(key)
+        etag, body = load()
+        body = jsonify(body).get_data()
+        response_cache.set(key, etag, body, generation)
+    else:
+        etag, body = entry
+
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    return response
+
+
+def invalidate_cached(movie_ids, actor_ids):
+    response_cache.invalidate(*([movie_key(id) for id in movie_ids] +
+                                [actor_key(id) for id in actor_ids]))
+
+
+'''
+Search
+    ranks Movies (by title) and Actors (by name) separately, `limit` of
+    each per page. The cursor holds the position of each list: null before
+    the first page, the [rank, id] of the last row returned, or false once
+    the list is exhausted
+'''
+
+
+def valid_search_position(position):
+    if position is None or position is False:
+        return True
+    return isinstance(position, list) and len(position) == 2 and \
+        all(isinstance(value, (int, float)) for value in position)
+
+
+def search_section(model, query, limit, position):
+    if position is False:
+        return [], False
+
+    matches = ranked_ids(db.session, model.__table__, query, limit + 1,
+                         position)
+    next_position = False
+    if len(matches) > limit:
+        matches = matches[:limit]
+        next_position = [matches[-1][1], matches[-1][0]]
+
+    ids = [id for id, rank in matches]
+    if model is Movie:
+        rows = Movie.query_with_actors().filter(Movie.id.in_(ids)).all()
+    else:
+        rows = Actor.query_with_movies().filter(Actor.id.in_(ids)).all()
+    rows_by_id = {row.id: row for row in rows}
+
+    return [rows_by_id[id].format() for id in ids if id in rows_by_id], \
+        next_position
+
+
+'''
+Cast and filmography
+    `GET /movies/<id>/actors` and `GET /actors/<id>/movies` page through
+    the Actors of a Movie (Movies of an Actor) in id order, with keyset
+    pagination over movies_actors (its primary key, and
+    ix_movies_actors_movie_id). `?fields=` applies; their own relationships
+    are only loaded with `?include=`
+
+    the single GETs take `?embed_limit=N` to embed only the first N names,
+    with the cursor of the next page of the sub-resource (`?include=`,
+    empty, omits the list)
+'''
+
+
+def related_query(model, parent_id, fields, include):
+    # The `model` rows linked to the Movie / Actor `parent_id`, and the
+    # movies_actors column their keyset is on
+    if model is Actor:
+        link, parent = movies_actors.c.actor_id, movies_actors.c.movie_id
+    else:
+        link, parent = movies_actors.c.movie_id, movies_actors.c.actor_id
+    query = query_fieldset(model, fields, include) \
+        .join(movies_actors, link == model.id).filter(parent == parent_id)
+    return query, link
+
+
+def related_page(parent_model, parent_id, model, key, default_limit,
+                 max_limit):
+    fields, include = get_fieldset(model)
+    if fields is None and 'include' not in request.args:
+        include = []
+
+    query, link = related_query(model, parent_id, fields, include)
+    total = list_total(query, model.__tablename__)
+    rows, next_cursor = paginate_keyset(query, [link], default_limit,
+                                        max_limit, keys=['id'])
+    if not rows and not existing_ids(parent_model, [parent_id]):
+        abort(404)
+
+    # As on the top-level lists, a link added after the last page changes
+    # its cursor and not its rows
+    return conditional_response(
+        make_etag(list_etag(rows, total, fields, include), next_cursor),
+        lambda: with_total({
+            'success': True,
+            key: [row.format(fields, include) for row in rows],
+            'next_cursor': next_cursor
+        }, total))
+
+
+def get_embed_limit(max_limit):
+    limit = get_int_arg('embed_limit')
+    if limit is not None and limit < 1:
+        abort(400)
+    return limit if limit is None else min(limit, max_limit)
+
+
+def capped_resource(model, row_id, key, related_model, relationship,
+                    fields, limit):
+    row = query_fieldset(model, fields, []).filter(
+        model.id == row_id).one_or_none()
+    if row is None:
+        abort(404)
+
+    name = related_model.search_column
+    query, link = related_query(related_model, row_id, [name], [])
+    related = query.order_by(link).limit(limit + 1).all()
+    next_cursor = None
+    if len(related) > limit:
+        related = related[:limit]
+        next_cursor = encode_cursor([related[-1].id])
+
+    def build_body():
+        body = row.format(fields, [])
+        body[relationship] = [getattr(item, name) for item in related]
+        body[relationship + '_next_cursor'] = next_cursor
+        return {'success': True, key: body}
+
+    return conditional_response(
+        make_etag(row.etag(fields, []), list_etag(related, None, [name]),
+                  next_cursor),
+        build_body)
+
+
+'''
+Cast editing
+    `POST /movies/<id>/actors` with {"actors": [ids]} adds Actors to the
+    cast of a Movie and `DELETE` removes them (the ids can also be passed
+    as `?ids=`); `/actors/<id>/movies` does the same from the Actor side.
+    The association rows are written with one set-based statement, and
+    neither collection is loaded
+'''
+
+
+def get_link_ids(key):
+    if request.method == 'DELETE' and 'ids' in request.args:
+        return parse_ids(request.args['ids'].split(','))
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        abort(400)
+    return parse_ids(body.get(key))
+
+
+def edit_links(model, row_id, related_model, key, make_pair, invalidate):
+    row = model.query.filter(model.id == row_id).one_or_none()
+    if row is None:
+        abort(404)
+
+    check_if_match(row)
+
+    ids = get_link_ids(key)
+    adding = request.method == 'POST'
+    # Unknown ids cannot be linked (nor, then, be linked already)
+    if adding and existing_ids(related_model, ids) != set(ids):
+        abort(400)
+
+    pairs = [make_pair(row_id, id) for id in ids]
+    try:
+        if adding:
+            changed = add_links(pairs)
+        else:
+            changed = remove_links(pairs)
+        db.session.commit()
+    except exc.SQLAlchemyError:
+        db.session.rollback()
+        abort(422)
+
+    invalidate(ids)
+    if adding:
+        costar_index.add_links(pairs)
+    else:
+        costar_index.remove_links(pairs)
+
+    return jsonify({
+        'success': True,
+        'added' if adding else 'removed': changed
+    })
+
+
+'''
+Co-stars
+    Actors linked by the Movies they share, read from the in-memory
+    co-star index (see models.costars), or from the database with
+    COSTAR_INDEX=false. The index is applied the cast changes of the write
+    routes after they commit
+'''
+
+
+def costar_counts(actor_id):
+    if COSTAR_INDEX:
+        costar_index.refresh(db.engine)
+        return costar_index.costars(actor_id)
+    return costars_sql(db.session.connection(), actor_id)
+
+
+def costar_path(source, target, max_depth):
+    if COSTAR_INDEX:
+        costar_index.refresh(db.engine)
+        return costar_index.shortest_path(source, target, max_depth)
+    return shortest_path_sql(db.session.connection(), source, target,
+                             max_depth)
+
+
+def values_by_id(column, ids):
+    table = column.table
+    if not ids:
+        return {}
+    return dict(db.session.execute(
+        select([table.c.id, column]).where(table.c.id.in_(ids))).fetchall())
 
 
 def create_app(test_config=None):
     app = Flask(__name__)
     setup_db(app)
+    app.json_encoder = encoder_from_env()
+    # after_request functions run in reverse order: compress the final body
+    init_compression(app)
+    init_metrics(app, db.engine)
+    # Before profiling, which authenticates: a shed request costs nothing
+    init_admission(app, {
+        'export_movies': 'export',
+        'export_actors': 'export',
+        'get_movies_batch': 'read',
+        'get_actors_batch': 'read',
+        # Monitoring stays available under overload
+        'get_metrics': None,
+        'get_pool_status': None,
+        'home_route': None
+    })
+    init_profiling(app, db.engine)
+    if COSTAR_INDEX:
+        costar_index.load(db.engine)
     # Set up CORS
     CORS(app)
 
@@ -35,37 +767,153 @@ def create_app(test_config=None):
             'message': 'Route Working'
         })
 
+    '''
+    Internal routes
+    '''
+    @app.route('/metrics', methods=['GET'])
+    @requires_auth('get:stats')
+    def get_metrics(payload):
+        return metrics_response()
+
+    @app.route('/internal/pool', methods=['GET'])
+    @requires_auth('get:stats')
+    def get_pool_status(payload):
+        return jsonify({
+            'success': True,
+            'pool': pool_status(db.engine)
+        })
+
+    @app.route('/search', methods=['GET'])
+    @requires_auth('get:movies')
+    def search(payload):
+        check_permissions('get:actors', payload)
+
+        query = request.args.get('q', '').strip()
+        if not query:
+            abort(400)
+
+        limit = get_limit(MOVIES_PER_PAGE, MOVIES_MAX_LIMIT)
+        positions = [None, None]
+        if request.args.get('after'):
+            positions = decode_cursor(request.args.get('after'), 2)
+            if not all(valid_search_position(position)
+                       for position in positions):
+                abort(400)
+
+        movies, movies_position = search_section(
+            Movie, query, limit, positions[0])
+        actors, actors_position = search_section(
+            Actor, query, limit, positions[1])
+
+        next_cursor = None
+        if movies_position is not False or actors_position is not False:
+            next_cursor = encode_cursor([movies_position, actors_position])
+
+        return jsonify({
+            'success': True,
+            'movies': movies,
+            'actors': actors,
+            'next_cursor': next_cursor
+        })
+
     '''
     Movies routes
     '''
     @app.route('/movies', methods=['GET'])
     @requires_auth('get:movies')
     def get_all_movies(payload):
+        if 'ids' in request.args:
+            return fetch_batch(Movie, 'movies',
+                               parse_ids(request.args['ids'].split(',')))
+
+        fields, include = get_fieldset(Movie)
+        columns, descending = get_sort(MOVIE_SORTS, Movie.id)
+        query = filter_movies(query_fieldset(Movie, fields, include, columns))
+        total = list_total(query, Movie.__tablename__)
+
+        if wants_keyset_pagination():
+            movies, next_cursor = paginate_keyset(
+                query, columns, MOVIES_PER_PAGE, MOVIES_MAX_LIMIT,
+                descending)
+
+            # The cursor is part of the page: a row appended after the last
+            # page changes its null next_cursor, not its rows
+            return conditional_response(
+                make_etag(list_etag(movies, total, fields, include),
+                          next_cursor),
+                lambda: with_total({
+                    'success': True,
+                    'movies': [movie.format(fields, include)
+                                 for movie in movies],
+                    'next_cursor': next_cursor
+                }, total))
+
         if request.args.get('page') is None:
             page = 1
         else:
             page = int(request.args.get('page'))
 
-        movies = Movie.query.order_by(Movie.id).paginate(
+        movies = query.order_by(*ordering(columns, descending)).paginate(
             page, MOVIES_PER_PAGE).items
 
-        return jsonify({
-            'success': True,
-            'movies': [movie.format() for movie in movies]
-        })
+        return conditional_response(
+            list_etag(movies, total, fields, include),
+            lambda: with_total({
+                'success': True,
+                'movies': [movie.format(fields, include)
+                             for movie in movies]
+            }, total))
+
+    @app.route('/movies/export', methods=['GET'])
+    @requires_auth('get:movies')
+    def export_movies(payload):
+        return export_ndjson(
+            [Movie.id, Movie.title, Movie.release_date], 'actors',
+            cast_names)
+
+    @app.route('/movies/batch', methods=['POST'])
+    @requires_auth('get:movies')
+    def get_movies_batch(payload):
+        body = request.get_json()
+
+        if not isinstance(body, dict):
+            abort(400)
+
+        return fetch_batch(Movie, 'movies', parse_ids(body.get('ids')))
 
     @app.route('/movies/<int:movie_id>', methods=['GET'])
     @requires_auth('get:movies')
     def get_single_movie(payload, movie_id):
-        movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
+        def load():
+            movie = Movie.query_with_actors().filter(
+                Movie.id == movie_id).one_or_none()
+
+            if movie is None:
+                abort(404)
 
+            return movie.etag(), {
+                'success': True,
+                'movie': movie.format()
+            }
+
+        fields, include = get_fieldset(Movie)
+        embed_limit = get_embed_limit(ACTORS_MAX_LIMIT)
+        if embed_limit is not None and 'actors' in include:
+            return capped_resource(Movie, movie_id, 'movie', Actor, 'actors',
+                                   fields, embed_limit)
+        if is_full_fieldset(Movie, fields, include):
+            return cached_resource(movie_key(movie_id), load)
+
+        # Sparse representations are not cached
+        movie = query_fieldset(Movie, fields, include).filter(
+            Movie.id == movie_id).one_or_none()
         if movie is None:
             abort(404)
-
-        return jsonify({
-            'success': True,
-            'movie': movie.format()
-        })
+        return conditional_response(
+            movie.etag(fields, include), lambda: {
+                'success': True,
+                'movie': movie.format(fields, include)
+            })
 
     @app.route('/movies', methods=['POST'])
     @requires_auth('post:movies')
@@ -82,7 +930,9 @@ def create_app(test_config=None):
             if title is None or release_date is None:
                 abort(400)
 
-            movie = Movie(title=title, release_date=release_date)
+            movie = Movie(title=title,
+                          release_date=date_parser.parse(
+                              str(release_date)).date())
             movie.insert()
 
             return jsonify({
@@ -93,33 +943,53 @@ def create_app(test_config=None):
         except:
             abort(422)
 
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('post:movies')
+    def post_movies_bulk(payload):
+        return bulk_create(
+            payload, Movie, 'movies', validate_movie,
+            lambda ids: invalidate_cached(ids, actor_ids_of_movies(ids)))
+
     @app.route('/movies/<int:movie_id>', methods=['PATCH'])
     @requires_auth('patch:movies')
     def update_movie(payload, movie_id):
-        try:
-            movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
+        movie = Movie.query.filter(Movie.id == movie_id).one_or_none()
 
-            if movie is None:
-                abort(404)
+        if movie is None:
+            abort(404)
+
+        check_if_match(movie)
 
+        try:
             body = request.get_json()
 
             if body is None:
                 abort(400)
 
+            actor_ids = actor_ids_of_movies([movie.id])
+
             # If the user provides a non-existent ID in the list of Actors
-            # for the movie, the request cannot be processed
+            # for the movie, the request cannot be processed. The cast is
+            # replaced by writing the difference only
+            costar_ids = set()
             if body.get('actors', None) is not None:
-                actors = Actor.query.filter(Actor.id.in_(body.get('actors'))).\
-                    all()
-                if len(actors) is not len(body.get('actors')):
+                # The ids may be sent as strings
+                costar_ids = set(int(id) for id in body.get('actors'))
+                if existing_ids(Actor, costar_ids) != costar_ids:
                     abort(400)
-                movie.actors = actors
+                remove_links([(id, movie.id)
+                              for id in actor_ids - costar_ids])
+                add_links([(id, movie.id) for id in costar_ids - actor_ids])
 
             movie.title = body.get('title', movie.title)
-            movie.release_date = body.get('release_date', movie.release_date)
+            if 'release_date' in body:
+                movie.release_date = date_parser.parse(
+                    str(body['release_date'])).date()
 
             movie.update()
+            invalidate_cached([movie_id], actor_ids | costar_ids)
+            if body.get('actors', None) is not None:
+                costar_index.set_cast(movie.id, costar_ids)
 
             return jsonify({
                 'success': True,
@@ -129,6 +999,21 @@ def create_app(test_config=None):
         except:
             abort(422)
 
+    @app.route('/movies/<int:movie_id>/actors', methods=['GET'])
+    @requires_auth('get:movies')
+    def get_movie_cast(payload, movie_id):
+        check_permissions('get:actors', payload)
+        return related_page(Movie, movie_id, Actor, 'actors',
+                            ACTORS_PER_PAGE, ACTORS_MAX_LIMIT)
+
+    @app.route('/movies/<int:movie_id>/actors', methods=['POST', 'DELETE'])
+    @requires_auth('patch:movies')
+    def edit_movie_cast(payload, movie_id):
+        return edit_links(
+            Movie, movie_id, Actor, 'actors',
+            lambda movie_id, actor_id: (actor_id, movie_id),
+            lambda ids: invalidate_cached([movie_id], ids))
+
     @app.route('/movies/<int:movie_id>', methods=['DELETE'])
     @requires_auth('delete:movies')
     def delete_movie(payload, movie_id):
@@ -137,9 +1022,14 @@ def create_app(test_config=None):
         if movie is None:
             abort(404)
 
+        check_if_match(movie)
+
+        actor_ids = actor_ids_of_movies([movie.id])
         movie.delete()
+        invalidate_cached([movie_id], actor_ids)
+        costar_index.remove_movie(movie_id)
 
-        total_movies = Movie.query.order_by(Movie.id).count()
+        total_movies = get_row_count(Movie.__tablename__)
 
         return jsonify({
             'success': True,
@@ -152,30 +1042,145 @@ def create_app(test_config=None):
     @app.route('/actors', methods=['GET'])
     @requires_auth('get:actors')
     def get_all_actors(payload):
+        if 'ids' in request.args:
+            return fetch_batch(Actor, 'actors',
+                               parse_ids(request.args['ids'].split(',')))
+
+        fields, include = get_fieldset(Actor)
+        columns, descending = get_sort(ACTOR_SORTS, Actor.id)
+        query = filter_actors(query_fieldset(Actor, fields, include, columns))
+        total = list_total(query, Actor.__tablename__)
+
+        if wants_keyset_pagination():
+            actors, next_cursor = paginate_keyset(
+                query, columns, ACTORS_PER_PAGE, ACTORS_MAX_LIMIT,
+                descending)
+
+            # The cursor is part of the page: a row appended after the last
+            # page changes its null next_cursor, not its rows
+            return conditional_response(
+                make_etag(list_etag(actors, total, fields, include),
+                          next_cursor),
+                lambda: with_total({
+                    'success': True,
+                    'actors': [actor.format(fields, include)
+                                 for actor in actors],
+                    'next_cursor': next_cursor
+                }, total))
+
         if request.args.get('page') is None:
             page = 1
         else:
             page = int(request.args.get('page'))
 
-        actors = Actor.query.order_by(Actor.id).paginate(
+        actors = query.order_by(*ordering(columns, descending)).paginate(
             page, ACTORS_PER_PAGE).items
 
-        return jsonify({
-            'success': True,
-            'actors': [actor.format() for actor in actors]
-        })
+        return conditional_response(
+            list_etag(actors, total, fields, include),
+            lambda: with_total({
+                'success': True,
+                'actors': [actor.format(fields, include)
+                             for actor in actors]
+            }, total))
+
+    @app.route('/actors/export', methods=['GET'])
+    @requires_auth('get:actors')
+    def export_actors(payload):
+        return export_ndjson(
+            [Actor.id, Actor.name, Actor.age, Actor.gender], 'movies',
+            filmography_titles)
+
+    @app.route('/actors/batch', methods=['POST'])
+    @requires_auth('get:actors')
+    def get_actors_batch(payload):
+        body = request.get_json()
+
+        if not isinstance(body, dict):
+            abort(400)
+
+        return fetch_batch(Actor, 'actors', parse_ids(body.get('ids')))
 
     @app.route('/actors/<int:actor_id>', methods=['GET'])
     @requires_auth('get:actors')
     def get_single_actor(payload, actor_id):
-        actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
+        def load():
+            actor = Actor.query_with_movies().filter(
+                Actor.id == actor_id).one_or_none()
 
+            if actor is None:
+                abort(404)
+
+            return actor.etag(), {
+                'success': True,
+                'actor': actor.format()
+            }
+
+        fields, include = get_fieldset(Actor)
+        embed_limit = get_embed_limit(MOVIES_MAX_LIMIT)
+        if embed_limit is not None and 'movies' in include:
+            return capped_resource(Actor, actor_id, 'actor', Movie, 'movies',
+                                   fields, embed_limit)
+        if is_full_fieldset(Actor, fields, include):
+            return cached_resource(actor_key(actor_id), load)
+
+        # Sparse representations are not cached
+        actor = query_fieldset(Actor, fields, include).filter(
+            Actor.id == actor_id).one_or_none()
         if actor is None:
             abort(404)
+        return conditional_response(
+            actor.etag(fields, include), lambda: {
+                'success': True,
+                'actor': actor.format(fields, include)
+            })
+
+    @app.route('/actors/<int:actor_id>/costars', methods=['GET'])
+    @requires_auth('get:actors')
+    def get_costars(payload, actor_id):
+        limit = get_limit(ACTORS_PER_PAGE, ACTORS_MAX_LIMIT)
+        shared = costar_counts(actor_id)
+        # Most shared Movies first
+        top = sorted(shared.items(), key=lambda item: (-item[1], item[0]))
+        top = top[:limit]
+
+        names = values_by_id(Actor.name, [actor_id] + [id for id, _ in top])
+        if actor_id not in names:
+            abort(404)
 
         return jsonify({
             'success': True,
-            'actor': actor.format()
+            'actor': actor_id,
+            'costars': [{'id': id, 'name': names[id], 'shared_movies': count}
+                        for id, count in top if id in names],
+            'total_costars': len(shared)
+        })
+
+    @app.route('/actors/<int:actor_id>/path/<int:other_id>',
+               methods=['GET'])
+    @requires_auth('get:actors')
+    def get_costar_path(payload, actor_id, other_id):
+        check_permissions('get:movies', payload)
+
+        max_depth = get_int_arg('max_depth')
+        if max_depth is None:
+            max_depth = COSTAR_MAX_DEPTH
+        if not 1 <= max_depth <= COSTAR_MAX_DEPTH:
+            abort(400)
+
+        path = costar_path(actor_id, other_id, max_depth)
+        actor_ids, movie_ids = path or ([], [])
+        names = values_by_id(
+            Actor.name, list(set([actor_id, other_id] + actor_ids)))
+        if actor_id not in names or other_id not in names:
+            abort(404)
+        titles = values_by_id(Movie.title, list(set(movie_ids)))
+
+        return jsonify({
+            'success': True,
+            'degrees': len(movie_ids) if path else None,
+            'actors': [{'id': id, 'name': names[id]} for id in actor_ids],
+            'movies': [{'id': id, 'title': titles[id]} for id in movie_ids]
         })
 
     @app.route('/actors', methods=['POST'])
@@ -208,28 +1213,43 @@ def create_app(test_config=None):
         except:
             abort(422)
 
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('post:actors')
+    def post_actors_bulk(payload):
+        return bulk_create(
+            payload, Actor, 'actors', validate_actor,
+            lambda ids: invalidate_cached(movie_ids_of_actors(ids), ids))
+
     @app.route('/actors/<int:actor_id>', methods=['PATCH'])
     @requires_auth('patch:actors')
     def update_actor(payload, actor_id):
-        try:
-            actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
+        actor = Actor.query.filter(Actor.id == actor_id).one_or_none()
 
-            if actor is None:
-                abort(404)
+        if actor is None:
+            abort(404)
+
+        check_if_match(actor)
 
+        try:
             body = request.get_json()
 
             if body is None:
                 abort(400)
 
+            movie_ids = movie_ids_of_actors([actor.id])
+
             # If the user provides a non-existent ID in the list of Movies
             # the Actor has been featured in, the request cannot be processed
+            filmography_ids = set()
             if body.get('movies', None) is not None:
-                movies = Movie.query.filter(Movie.id.in_(body.get('movies'))).\
-                    all()
-                if len(movies) is not len(body.get('movies')):
+                # The ids may be sent as strings
+                filmography_ids = set(int(id) for id in body.get('movies'))
+                if existing_ids(Movie, filmography_ids) != filmography_ids:
                     abort(400)
-                actor.movies = movies
+                remove_links([(actor.id, id)
+                              for id in movie_ids - filmography_ids])
+                add_links([(actor.id, id)
+                           for id in filmography_ids - movie_ids])
 
             actor.name = body.get('name', actor.name)
             actor.age = body.get('age', actor.age)
@@ -239,6 +1259,9 @@ def create_app(test_config=None):
                 abort(400)
 
             actor.update()
+            invalidate_cached(movie_ids | filmography_ids, [actor_id])
+            if body.get('movies', None) is not None:
+                costar_index.set_filmography(actor.id, filmography_ids)
 
             return jsonify({
                 'success': True,
@@ -248,6 +1271,21 @@ def create_app(test_config=None):
         except:
             abort(422)
 
+    @app.route('/actors/<int:actor_id>/movies', methods=['GET'])
+    @requires_auth('get:actors')
+    def get_actor_filmography(payload, actor_id):
+        check_permissions('get:movies', payload)
+        return related_page(Actor, actor_id, Movie, 'movies',
+                            MOVIES_PER_PAGE, MOVIES_MAX_LIMIT)
+
+    @app.route('/actors/<int:actor_id>/movies', methods=['POST', 'DELETE'])
+    @requires_auth('patch:actors')
+    def edit_actor_filmography(payload, actor_id):
+        return edit_links(
+            Actor, actor_id, Movie, 'movies',
+            lambda actor_id, movie_id: (actor_id, movie_id),
+            lambda ids: invalidate_cached(ids, [actor_id]))
+
     @app.route('/actors/<int:actor_id>', methods=['DELETE'])
     @requires_auth('delete:actors')
     def delete_actor(payload, actor_id):
@@ -256,9 +1294,14 @@ def create_app(test_config=None):
         if actor is None:
             abort(404)
 
+        check_if_match(actor)
+
+        movie_ids = movie_ids_of_actors([actor.id])
         actor.delete()
+        invalidate_cached(movie_ids, [actor_id])
+        costar_index.remove_actor(actor_id)
 
-        total_actors = Actor.query.order_by(Actor.id).count()
+        total_actors = get_row_count(Actor.__tablename__)
 
         return jsonify({
             'success': True,
@@ -285,6 +1328,34 @@ def create_app(test_config=None):
             "message": "bad request"
         }), 400
 
+    @app.errorhandler(413)
+    def payload_too_large(error):
+        return jsonify({
+            "success": False,
+            "error": 413,
+            "message": "payload too large"
+        }), 413
+
+    @app.errorhandler(412)
+    def precondition_failed(error):
+        return jsonify({
+            "success": False,
+            "error": 412,
+            "message": "precondition failed"
+        }), 412
+
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        response = jsonify({
+            "success": False,
+            "error": 503,
+            "message": "service unavailable"
+        })
+        response.status_code = 503
+        if getattr(error, 'retry_after', None):
+            response.headers['Retry-After'] = str(error.retry_after)
+        return response
+
     @app.errorhandler(404)
     def not_found(error):
         return jsonify({
@@ -0,0 +1,21 @@
+'''
+Cooperative serving mode
+    the same application as app.py (routes, auth and error handlers), for
+    gunicorn's gevent worker:
+
+        gunicorn -k gevent --worker-connections 2000 async_app:app
+
+    blocking I/O is made cooperative: sockets (JWKS fetches, Redis) through
+    gevent's monkey patching, and PostgreSQL queries through psycopg2's wait
+    callback (psycogreen). A worker holds thousands of connections, each
+    parked while it waits on the network or the database, instead of one
+    request per sync worker. Concurrent queries are still bounded by the
+    SQLAlchemy connection pool
+'''
+from gevent import monkey
+monkey.patch_all()
+
+from psycogreen.gevent import patch_psycopg  # noqa: E402
+patch_psycopg()
+
+from app import app  # noqa: E402, F401
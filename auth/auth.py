@@ -1,14 +1,39 @@
-import json
 from flask import request, _request_ctx_stack, Flask, abort, jsonify
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
 import os
+import time
 
-AUTH0_DOMAIN = os.gentenv('AUTH0_DOMAIN')
+from auth.jwks import JWKSKeyStore, source_from_string
+from auth.token_cache import TokenCache
+from metrics.metrics import observe_auth, observe_jwks_fetch
+
+AUTH0_DOMAIN = os.getenv('AUTH0_DOMAIN')
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'dev'
 
+# The JWKS can be read from another URL or from a local file (tests,
+# benchmarks) by setting JWKS_SOURCE
+JWKS_SOURCE = os.getenv('JWKS_SOURCE',
+                        f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+JWKS_CACHE_TTL = int(os.getenv('JWKS_CACHE_TTL', 3600))
+JWKS_STALE_TTL = int(os.getenv('JWKS_STALE_TTL', 300))
+JWKS_MIN_REFETCH_INTERVAL = int(os.getenv('JWKS_MIN_REFETCH_INTERVAL', 30))
+
+jwks_store = JWKSKeyStore(source_from_string(JWKS_SOURCE),
+                          algorithm=ALGORITHMS[0],
+                          ttl=JWKS_CACHE_TTL,
+                          stale_ttl=JWKS_STALE_TTL,
+                          min_refetch_interval=JWKS_MIN_REFETCH_INTERVAL,
+                          on_fetch=observe_jwks_fetch)
+
+# Verified tokens are cached until their expiry (at most TOKEN_CACHE_TTL
+# seconds), TOKEN_CACHE_SIZE=0 disables the cache
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 1024))
+TOKEN_CACHE_TTL = int(os.getenv('TOKEN_CACHE_TTL', 300))
+
+token_cache = TokenCache(max_size=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL)
+
 # AuthError Exception
 '''
 AuthError Exception
@@ -108,36 +133,24 @@ def check_permissions(permission, payload):
 
 
 def verify_decode_jwt(token):
-    # GET THE PUBLIC KEY FROM AUTH0
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
-
     # GET THE DATA IN THE HEADER
     unverified_header = jwt.get_unverified_header(token)
 
     # CHOOSE OUR KEY
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
-    if rsa_key:
+    # GET THE PUBLIC KEY FROM THE (CACHED) AUTH0 JWKS
+    rsa_key = jwks_store.get_key(unverified_header['kid'])
+    if rsa_key is not None:
         try:
             # USE THE KEY TO VALIDATE THE JWT
             payload = jwt.decode(
                 token,
-                rsa_key,
+                [rsa_key],
                 algorithms=ALGORITHMS,
                 audience=API_AUDIENCE,
                 issuer='https://' + AUTH0_DOMAIN + '/'
@@ -168,6 +181,33 @@ def verify_decode_jwt(token):
     }, 400)
 
 
+'''
+authenticate()
+    returns the payload of the bearer token of the request, from the token
+    cache or verified with verify_decode_jwt
+'''
+
+
+def authenticate():
+    token = get_token_auth_header()
+    started = time.perf_counter()
+    payload = token_cache.get(token)
+    if payload is None:
+        try:
+            payload = verify_decode_jwt(token)
+        except Exception:
+            observe_auth(time.perf_counter() - started, 'failed')
+            raise AuthError({
+                'code': 'unauthorized',
+                'description': 'Permission not found.'
+            }, 401)
+        payload = token_cache.put(token, payload)
+        observe_auth(time.perf_counter() - started, 'verified')
+    else:
+        observe_auth(time.perf_counter() - started, 'cached')
+    return payload
+
+
 '''
 @TODO implement @requires_auth(permission) decorator method
     @INPUTS
@@ -186,15 +226,7 @@ def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            try:
-                payload = verify_decode_jwt(token)
-            except Exception:
-                raise AuthError({
-                    'code': 'unauthorized',
-                    'description': 'Permission not found.'
-                }, 401)
-
+            payload = authenticate()
             check_permissions(permission, payload)
             return f(payload, *args, **kwargs)
 
@@ -0,0 +1,186 @@
+import json
+import logging
+import threading
+import time
+from urllib.request import urlopen
+
+from jose import jwk
+
+logger = logging.getLogger(__name__)
+
+'''
+JWKS sources
+    a source is any callable returning the JWKS document as a dict
+    ({'keys': [...]}), so the key store can be pointed at Auth0, a local
+    file or a stub server in tests and benchmarks
+'''
+
+
+def url_source(url, timeout=5):
+    def fetch():
+        with urlopen(url, timeout=timeout) as response:
+            return json.loads(response.read())
+    return fetch
+
+
+def file_source(path):
+    def fetch():
+        with open(path) as jwks_file:
+            return json.load(jwks_file)
+    return fetch
+
+
+def static_source(jwks):
+    def fetch():
+        return jwks
+    return fetch
+
+
+def source_from_string(value, timeout=5):
+    if value.startswith('http://') or value.startswith('https://'):
+        return url_source(value, timeout)
+    if value.startswith('file://'):
+        value = value[len('file://'):]
+    return file_source(value)
+
+
+'''
+JWKSKeyStore
+    caches the JWKS document and the RSA key objects built from it (per
+    kid), so verifying a token does not cost a round trip to the identity
+    provider nor a key reconstruction
+
+    - keys are fresh for `ttl` seconds
+    - for `stale_ttl` more seconds, cached keys are still served while a
+    background thread refreshes them (stale-while-revalidate)
+    - past that, the refresh is done inline; if it fails, the last known
+    keys are kept rather than failing every request
+    - an unknown kid triggers an inline refetch, at most once every
+    `min_refetch_interval` seconds
+
+    `on_fetch`, if set, is called with True / False after every fetch
+'''
+
+
+class JWKSKeyStore:
+    def __init__(self, source, algorithm='RS256', ttl=3600, stale_ttl=300,
+                 min_refetch_interval=30, clock=time.monotonic,
+                 on_fetch=None):
+        self.source = source
+        self.algorithm = algorithm
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.min_refetch_interval = min_refetch_interval
+        self.clock = clock
+        self.on_fetch = on_fetch
+
+        self.fetch_count = 0
+        self.fetch_errors = 0
+
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def set_source(self, source):
+        with self._lock:
+            self.source = source
+            self._keys = {}
+            self._fetched_at = None
+            self._last_attempt = None
+
+    def _build_keys(self, jwks):
+        keys = {}
+        for key in jwks.get('keys', []):
+            if 'kid' not in key or key.get('kty') != 'RSA':
+                continue
+            if key.get('use', 'sig') != 'sig':
+                continue
+            try:
+                # Keep the backend key object (rsa / cryptography public
+                # key), jwt.decode accepts it without re-parsing the JWK
+                constructed = jwk.construct({
+                    'kty': key['kty'],
+                    'kid': key['kid'],
+                    'use': key.get('use', 'sig'),
+                    'n': key['n'],
+                    'e': key['e']
+                }, self.algorithm)
+                keys[key['kid']] = getattr(constructed, '_prepared_key',
+                                           constructed)
+            except Exception:
+                logger.warning('Skipping unusable JWK %s', key.get('kid'))
+        return keys
+
+    def refresh(self):
+        with self._lock:
+            self._last_attempt = self.clock()
+            source = self.source
+        try:
+            jwks = source()
+            keys = self._build_keys(jwks)
+        except Exception:
+            with self._lock:
+                self.fetch_errors += 1
+            logger.exception('Unable to fetch the JWKS')
+            if self.on_fetch:
+                self.on_fetch(False)
+            return False
+
+        with self._lock:
+            self.fetch_count += 1
+            self._keys = keys
+            self._fetched_at = self.clock()
+        if self.on_fetch:
+            self.on_fetch(True)
+        return True
+
+    def _rate_limited_refresh(self):
+        with self._lock:
+            last_attempt = self._last_attempt
+        if last_attempt is not None and \
+                self.clock() - last_attempt < self.min_refetch_interval:
+            return False
+        return self.refresh()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _ensure_fresh(self):
+        with self._lock:
+            fetched_at = self._fetched_at
+            if fetched_at is None:
+                inline = True
+            else:
+                age = self.clock() - fetched_at
+                if age < self.ttl:
+                    return
+                inline = age >= self.ttl + self.stale_ttl
+                if not inline:
+                    if self._refreshing:
+                        return
+                    self._refreshing = True
+
+        if inline:
+            self._rate_limited_refresh()
+        else:
+            threading.Thread(target=self._background_refresh,
+                             daemon=True).start()
+
+    def get_key(self, kid):
+        self._ensure_fresh()
+
+        key = self._keys.get(kid)
+        if key is not None:
+            return key
+
+        # Unknown kid: the provider may have rotated its keys, refetch
+        # (rate-limited so that garbage kids cannot hammer the provider)
+        if self._rate_limited_refresh():
+            key = self._keys.get(kid)
+        return key
@@ -0,0 +1,89 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+'''
+TokenCache
+    bounded LRU of verified JWT payloads, keyed by a SHA-256 of the token
+    (the raw bearer token is never kept in memory)
+
+    an entry lives until the token's `exp` claim, capped to `ttl` seconds
+    after it was verified. Permissions are stored as a frozenset so that
+    check_permissions does a hash lookup instead of scanning a list
+'''
+
+
+class TokenCache:
+    def __init__(self, max_size=1024, ttl=300, clock=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def get(self, token):
+        if self.max_size <= 0:
+            return None
+
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires_at, payload = entry
+            if self.clock() >= expires_at:
+                del self._entries[key]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return payload
+
+    def put(self, token, payload):
+        if self.max_size <= 0:
+            return payload
+
+        payload = dict(payload)
+        if 'permissions' in payload:
+            payload['permissions'] = frozenset(payload['permissions'])
+
+        expires_at = self.clock() + self.ttl
+        if 'exp' in payload:
+            expires_at = min(expires_at, payload['exp'])
+
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (expires_at, payload)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return payload
+
+    def invalidate(self, token):
+        with self._lock:
+            return self._entries.pop(self._key(token), None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses
+            }
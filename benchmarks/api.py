@@ -0,0 +1,425 @@
+'''
+Offline API benchmark
+    runs the app in-process against a seeded database, with tokens signed
+    by a local RSA key (the JWKS is read from a temporary file, no Auth0),
+    drives every route from `concurrency` threads and reports, per route,
+    throughput, p50 / p95 / p99 latency and SQL statements per request
+
+        python benchmarks/api.py --actors 5000 --movies 1000 \
+            --requests 500 --concurrency 8 --output results.json
+        python benchmarks/api.py ... --baseline results.json
+
+    the database defaults to a temporary SQLite file (--database takes any
+    SQLAlchemy URI, e.g. an empty PostgreSQL database). With --baseline,
+    the results are compared route by route, and the exit status is 1 when
+    a route regressed by more than --threshold percent
+'''
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+import rsa
+from jose import jwt
+from jose.utils import base64url_encode, long_to_bytes
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+AUTH0_DOMAIN = 'benchmark.local'
+KEY_ID = 'benchmark-key'
+PERMISSIONS = [
+    'get:movies', 'get:actors', 'post:movies', 'post:actors',
+    'patch:movies', 'patch:actors', 'delete:movies', 'delete:actors',
+    'get:stats'
+]
+WORDS = ['alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf',
+         'hotel', 'india', 'juliet', 'kilo', 'lima', 'mike', 'november']
+
+
+def make_keys(directory):
+    public_key, private_key = rsa.newkeys(2048)
+    jwks_path = os.path.join(directory, 'jwks.json')
+    with open(jwks_path, 'w') as jwks_file:
+        json.dump({'keys': [{
+            'kty': 'RSA',
+            'kid': KEY_ID,
+            'use': 'sig',
+            'n': base64url_encode(long_to_bytes(public_key.n)).decode(),
+            'e': base64url_encode(long_to_bytes(public_key.e)).decode()
+        }]}, jwks_file)
+    return private_key.save_pkcs1().decode(), jwks_path
+
+
+def make_token(private_key):
+    return jwt.encode({
+        'iss': f'https://{AUTH0_DOMAIN}/',
+        'aud': 'dev',
+        'sub': 'benchmark',
+        'exp': int(time.time()) + 24 * 3600,
+        'permissions': PERMISSIONS
+    }, private_key, algorithm='RS256', headers={'kid': KEY_ID})
+
+
+def configure_environment(database, jwks_path):
+    # Read by the app modules when they are imported
+    os.environ.update(DB_URI=database, AUTH0_DOMAIN=AUTH0_DOMAIN,
+                      JWKS_SOURCE=jwks_path)
+    os.environ.setdefault('MOVIES_PER_PAGE', '10')
+    os.environ.setdefault('ACTORS_PER_PAGE', '10')
+
+
+def title(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 4)))
+
+
+def seed_dataset(nb_actors, nb_movies, max_cast, extra, seed):
+    # extra: Movies and Actors without cast, and links outside of the
+    # casts (for both link DELETE routes), consumed by the DELETE routes
+    from sqlalchemy import func, select
+    from models.models import db, bulk_write, movies_actors, Actor, Movie
+    from models.costars import COSTAR_INDEX, costar_index
+
+    rng = random.Random(seed)
+    first_actor = (db.session.execute(
+        select([func.max(Actor.id)])).scalar() or 0) + 1
+    first_movie = (db.session.execute(
+        select([func.max(Movie.id)])).scalar() or 0) + 1
+
+    bulk_write(Actor, [
+        {'id': first_actor + index, 'name': title(rng),
+         'age': rng.randint(18, 80), 'gender': rng.choice(['male', 'female'])}
+        for index in range(nb_actors + extra)])
+    bulk_write(Movie, [
+        {'id': first_movie + index, 'title': title(rng),
+         'release_date': date(1950, 1, 1) + timedelta(
+             days=rng.randint(0, 25000))}
+        for index in range(nb_movies + extra)])
+
+    actor_ids = list(range(first_actor, first_actor + nb_actors))
+    movie_ids = list(range(first_movie, first_movie + nb_movies))
+    cast = [{'movie_id': movie_id, 'actor_id': actor_id}
+            for movie_id in movie_ids
+            for actor_id in rng.sample(actor_ids,
+                                       min(rng.randint(1, max_cast),
+                                           len(actor_ids)))]
+    linked = {(link['movie_id'], link['actor_id']) for link in cast}
+    spare = min(2 * extra, len(movie_ids) * len(actor_ids) - len(linked))
+    links = []
+    while len(links) < spare:
+        pair = (rng.choice(movie_ids), rng.choice(actor_ids))
+        if pair not in linked:
+            linked.add(pair)
+            links.append(pair)
+    cast += [{'movie_id': movie_id, 'actor_id': actor_id}
+             for movie_id, actor_id in links]
+    if cast:
+        db.session.execute(movies_actors.insert(), cast)
+    db.session.commit()
+    # The co-star index was built at startup, before the cast existed
+    if COSTAR_INDEX:
+        costar_index.load(db.engine)
+
+    return {
+        'actor_ids': actor_ids,
+        'movie_ids': movie_ids,
+        'deletable_actors': deque(range(first_actor + nb_actors,
+                                        first_actor + nb_actors + extra)),
+        'deletable_movies': deque(range(first_movie + nb_movies,
+                                        first_movie + nb_movies + extra)),
+        'deletable_links': deque(links)
+    }
+
+
+'''
+Scenarios
+    one per route: (name, method, path(data, rng), body(data, rng)); the
+    DELETE routes consume the rows seeded for them. body is called after
+    path, on the same thread: the link DELETEs pop a (movie, actor) link in
+    path, and send its other id in body
+'''
+deleted_link = threading.local()
+
+
+def pop_link(data):
+    deleted_link.movie_id, deleted_link.actor_id = \
+        data['deletable_links'].popleft()
+    return deleted_link
+
+
+def no_body(data, rng):
+    return None
+
+
+def movie_body(data, rng):
+    return {'title': title(rng), 'release_date': '2001-02-03'}
+
+
+def actor_body(data, rng):
+    return {'name': title(rng), 'age': rng.randint(18, 80),
+            'gender': rng.choice(['male', 'female'])}
+
+
+SCENARIOS = [
+    ('home', 'GET', lambda data, rng: '/', no_body),
+    ('search', 'GET',
+     lambda data, rng: f'/search?q={rng.choice(WORDS)}', no_body),
+    ('list_movies', 'GET',
+     lambda data, rng: f'/movies?page={rng.randint(1, 5)}', no_body),
+    ('list_movies_cursor', 'GET',
+     lambda data, rng: '/movies?limit=50&sort=-release_date', no_body),
+    ('export_movies', 'GET', lambda data, rng: '/movies/export', no_body),
+    ('get_movie', 'GET',
+     lambda data, rng: f'/movies/{rng.choice(data["movie_ids"])}', no_body),
+    ('batch_movies', 'GET',
+     lambda data, rng: '/movies?ids=' + ','.join(
+         str(id) for id in rng.sample(data['movie_ids'], 20)), no_body),
+    ('post_movie', 'POST', lambda data, rng: '/movies', movie_body),
+    ('post_movies_bulk', 'POST', lambda data, rng: '/movies/bulk',
+     lambda data, rng: [movie_body(data, rng) for _ in range(10)]),
+    ('patch_movie', 'PATCH',
+     lambda data, rng: f'/movies/{rng.choice(data["movie_ids"])}',
+     lambda data, rng: {'title': title(rng)}),
+    ('movie_cast', 'GET',
+     lambda data, rng: f'/movies/{rng.choice(data["movie_ids"])}/actors',
+     no_body),
+    ('movie_embed_limit', 'GET',
+     lambda data, rng:
+     f'/movies/{rng.choice(data["movie_ids"])}?embed_limit=3', no_body),
+    ('add_cast', 'POST',
+     lambda data, rng: f'/movies/{rng.choice(data["movie_ids"])}/actors',
+     lambda data, rng: {'actors': [rng.choice(data['actor_ids'])]}),
+    ('delete_cast', 'DELETE',
+     lambda data, rng: f'/movies/{pop_link(data).movie_id}/actors',
+     lambda data, rng: {'actors': [deleted_link.actor_id]}),
+    ('delete_movie', 'DELETE',
+     lambda data, rng: f'/movies/{data["deletable_movies"].popleft()}',
+     no_body),
+    ('list_actors', 'GET',
+     lambda data, rng: f'/actors?page={rng.randint(1, 5)}', no_body),
+    ('list_actors_cursor', 'GET',
+     lambda data, rng: '/actors?limit=50&gender=female&sort=age', no_body),
+    ('export_actors', 'GET', lambda data, rng: '/actors/export', no_body),
+    ('get_actor', 'GET',
+     lambda data, rng: f'/actors/{rng.choice(data["actor_ids"])}', no_body),
+    ('filmography', 'GET',
+     lambda data, rng: f'/actors/{rng.choice(data["actor_ids"])}/movies',
+     no_body),
+    ('actor_embed_limit', 'GET',
+     lambda data, rng:
+     f'/actors/{rng.choice(data["actor_ids"])}?embed_limit=3', no_body),
+    ('add_filmography', 'POST',
+     lambda data, rng: f'/actors/{rng.choice(data["actor_ids"])}/movies',
+     lambda data, rng: {'movies': [rng.choice(data['movie_ids'])]}),
+    ('delete_filmography', 'DELETE',
+     lambda data, rng: f'/actors/{pop_link(data).actor_id}/movies',
+     lambda data, rng: {'movies': [deleted_link.movie_id]}),
+    ('batch_actors', 'POST', lambda data, rng: '/actors/batch',
+     lambda data, rng: {'ids': rng.sample(data['actor_ids'], 100)}),
+    ('costars', 'GET',
+     lambda data, rng: f'/actors/{rng.choice(data["actor_ids"])}/costars',
+     no_body),
+    ('costar_path', 'GET',
+     lambda data, rng: '/actors/{}/path/{}'.format(
+         *rng.sample(data['actor_ids'], 2)), no_body),
+    ('post_actor', 'POST', lambda data, rng: '/actors', actor_body),
+    ('post_actors_bulk', 'POST', lambda data, rng: '/actors/bulk',
+     lambda data, rng: [actor_body(data, rng) for _ in range(10)]),
+    ('patch_actor', 'PATCH',
+     lambda data, rng: f'/actors/{rng.choice(data["actor_ids"])}',
+     lambda data, rng: {'age': rng.randint(18, 80)}),
+    ('delete_actor', 'DELETE',
+     lambda data, rng: f'/actors/{data["deletable_actors"].popleft()}',
+     no_body),
+    ('pool_status', 'GET', lambda data, rng: '/internal/pool', no_body),
+    ('metrics', 'GET', lambda data, rng: '/metrics', no_body),
+]
+
+
+'''
+SQL statements are counted per thread, around each request
+'''
+sql_counter = threading.local()
+
+
+def count_statement(conn, cursor, statement, parameters, context,
+                    executemany):
+    if getattr(sql_counter, 'active', False):
+        sql_counter.count += 1
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def run_scenario(app, scenario, data, headers, requests, concurrency,
+                 seed):
+    name, method, path, body = scenario
+    per_thread = [requests // concurrency + (index < requests % concurrency)
+                  for index in range(concurrency)]
+
+    def worker(index):
+        client = app.test_client()
+        rng = random.Random(f'{seed}-{name}-{index}')
+        results = []
+        for _ in range(per_thread[index]):
+            url = path(data, rng)
+            payload = body(data, rng)
+            sql_counter.count = 0
+            sql_counter.active = True
+            started = time.perf_counter()
+            response = client.open(url, method=method, headers=headers,
+                                   json=payload)
+            # Consume streamed bodies (exports) inside the measure
+            response.get_data()
+            elapsed = time.perf_counter() - started
+            sql_counter.active = False
+            results.append((elapsed, sql_counter.count,
+                            response.status_code < 400))
+        return results
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = [result for thread_results in executor.map(
+            worker, range(concurrency)) for result in thread_results]
+    wall = time.perf_counter() - started
+
+    latencies = sorted(elapsed for elapsed, _, _ in results)
+    return {
+        'method': method,
+        'requests': len(results),
+        'errors': sum(1 for _, _, succeeded in results if not succeeded),
+        'throughput': len(results) / wall if wall else 0.0,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'sql_per_request': sum(count for _, count, _ in results) /
+        max(len(results), 1)
+    }
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    print(f'\n{"route":<22}{"p95 ms":>10}{"base":>10}{"delta":>9}'
+          f'{"req/s":>10}{"base":>10}{"delta":>9}{"sql":>7}{"base":>7}')
+    for name, route in results['routes'].items():
+        base = baseline['routes'].get(name)
+        if base is None:
+            continue
+        p95_delta = (route['p95_ms'] / base['p95_ms'] - 1) * 100 \
+            if base['p95_ms'] else 0.0
+        throughput_delta = \
+            (route['throughput'] / base['throughput'] - 1) * 100 \
+            if base['throughput'] else 0.0
+        print(f'{name:<22}{route["p95_ms"]:>10.2f}{base["p95_ms"]:>10.2f}'
+              f'{p95_delta:>+8.1f}%{route["throughput"]:>10.1f}'
+              f'{base["throughput"]:>10.1f}{throughput_delta:>+8.1f}%'
+              f'{route["sql_per_request"]:>7.1f}'
+              f'{base["sql_per_request"]:>7.1f}')
+        if p95_delta > threshold or throughput_delta < -threshold or \
+                route['sql_per_request'] > base['sql_per_request'] + 0.5:
+            regressions.append(name)
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark every route of the API, offline.')
+    parser.add_argument('--database',
+                        help='SQLAlchemy URI (default: temporary SQLite)')
+    parser.add_argument('--actors', type=int, default=2000)
+    parser.add_argument('--movies', type=int, default=500)
+    parser.add_argument('--max-cast', type=int, default=5)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per route')
+    parser.add_argument('--warmup', type=int, default=10,
+                        help='unmeasured requests per route')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--routes', nargs='+',
+                        choices=[scenario[0] for scenario in SCENARIOS],
+                        help='only benchmark these routes')
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--baseline', help='results to compare against')
+    parser.add_argument('--threshold', type=float, default=20,
+                        help='regression threshold, in percent')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    directory = tempfile.mkdtemp(prefix='casting-benchmark-')
+    database = args.database or \
+        f'sqlite:///{os.path.join(directory, "benchmark.db")}'
+    private_key, jwks_path = make_keys(directory)
+    configure_environment(database, jwks_path)
+
+    from sqlalchemy import event
+    from app import app
+    from models.models import db
+
+    scenarios = [scenario for scenario in SCENARIOS
+                 if not args.routes or scenario[0] in args.routes]
+    headers = {'Authorization': f'Bearer {make_token(private_key)}'}
+
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', count_statement)
+        started = time.perf_counter()
+        data = seed_dataset(args.actors, args.movies, args.max_cast,
+                            args.requests + args.warmup, args.seed)
+        print(f'Seeded {args.actors} actors and {args.movies} movies in '
+              f'{time.perf_counter() - started:.1f}s ({database})')
+
+    results = {
+        'meta': {
+            'date': datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'database': database.split(':', 1)[0],
+            'actors': args.actors,
+            'movies': args.movies,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'seed': args.seed
+        },
+        'routes': {}
+    }
+
+    print(f'{"route":<22}{"req":>6}{"err":>5}{"req/s":>10}{"p50 ms":>9}'
+          f'{"p95 ms":>9}{"p99 ms":>9}{"sql":>6}')
+    for scenario in scenarios:
+        if args.warmup:
+            run_scenario(app, scenario, data, headers, args.warmup,
+                         min(args.concurrency, args.warmup), args.seed)
+        route = run_scenario(app, scenario, data, headers, args.requests,
+                             args.concurrency, args.seed)
+        results['routes'][scenario[0]] = route
+        print(f'{scenario[0]:<22}{route["requests"]:>6}{route["errors"]:>5}'
+              f'{route["throughput"]:>10.1f}{route["p50_ms"]:>9.2f}'
+              f'{route["p95_ms"]:>9.2f}{route["p99_ms"]:>9.2f}'
+              f'{route["sql_per_request"]:>6.1f}')
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file),
+                                  args.threshold)
+        if regressions:
+            print(f'\nRegressions: {", ".join(regressions)}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+'''
+Response compression benchmark
+    compresses realistic response bodies (list pages of formatted Movies
+    and Actors, and an NDJSON export batch, built in memory) with gzip and
+    brotli at several levels, and prints for each the compressed size, the
+    CPU time per body, and the transfer time saved on a given link, to
+    pick COMPRESSION_LEVEL / BROTLI_QUALITY / COMPRESSION_MIN_SIZE
+
+        python benchmarks/compression.py --page-sizes 10 100 --mbps 10
+'''
+import argparse
+import os
+import random
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from serialization.compression import brotli, compress, \
+    compress_chunks  # noqa: E402
+from serialization.encoders import orjson_encoder  # noqa: E402
+from benchmarks.json_encoding import actors_page, encode, \
+    movies_page  # noqa: E402
+
+GZIP_LEVELS = [1, 6, 9]
+BROTLI_QUALITIES = [1, 4, 8, 11]
+
+
+def bodies(page_sizes, rng):
+    encoder = orjson_encoder('iso')
+    for size in page_sizes:
+        yield f'movies/{size}', encode(
+            encoder, movies_page(size, rng)).encode('utf-8')
+        yield f'actors/{size}', encode(
+            encoder, actors_page(size, rng)).encode('utf-8')
+
+    yield 'export/1000', export_batch(rng)
+
+
+def export_batch(rng, size=1000):
+    # One Movie per line, as written by the export routes
+    encoder = orjson_encoder('iso')
+    lines = [encode(encoder, movie) for movie
+             in movies_page(size, rng)['movies']]
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def settings():
+    for level in GZIP_LEVELS:
+        yield f'gzip {level}', 'gzip', {'level': level}
+    if brotli is not None:
+        for quality in BROTLI_QUALITIES:
+            yield f'br {quality}', 'br', {'quality': quality}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Compare compression settings on response bodies.')
+    parser.add_argument('--page-sizes', type=int, nargs='+',
+                        default=[10, 100])
+    parser.add_argument('--number', type=int, default=200,
+                        help='bodies compressed per measure')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--mbps', type=float, default=10,
+                        help='link speed for the transfer time saved')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    rng = random.Random(0)
+    bytes_per_ms = args.mbps * 1e6 / 8 / 1000
+
+    if brotli is None:
+        print('brotli is not installed: gzip only')
+    print(f'{"body":<14}{"setting":<10}{"bytes":>9}{"ratio":>7}'
+          f'{"cpu ms":>9}{"saved ms":>10}{"MB/s":>8}')
+    for label, body in bodies(args.page_sizes, rng):
+        print(f'{label:<14}{"identity":<10}{len(body):>9,}')
+        for name, encoding, options in settings():
+            compressed = compress(body, encoding, **options)
+            best = min(timeit.repeat(
+                lambda: compress(body, encoding, **options),
+                number=args.number, repeat=args.repeat)) / args.number
+            saved = (len(body) - len(compressed)) / bytes_per_ms
+            print(f'{"":<14}{name:<10}{len(compressed):>9,}'
+                  f'{len(body) / len(compressed):>6.1f}x'
+                  f'{best * 1000:>9.3f}{saved:>10.2f}'
+                  f'{len(body) / best / 1e6:>8.0f}')
+
+    # Streaming: the export compressed batch by batch, each batch flushed
+    batches = [export_batch(rng) for _ in range(10)]
+    print('\nexport, 10 batches compressed and flushed one by one')
+    for encoding in ['gzip'] + (['br'] if brotli is not None else []):
+        streamed = b''.join(compress_chunks(iter(batches), encoding))
+        whole = compress(b''.join(batches), encoding)
+        print(f'{encoding:<10}{len(streamed):>9,} bytes '
+              f'({len(whole):>9,} in one piece)')
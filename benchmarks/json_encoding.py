@@ -0,0 +1,95 @@
+'''
+JSON encoder micro-benchmark
+    encodes full list pages of formatted Movies and Actors (built in
+    memory, no database) with each JSON encoder and date format, the way
+    jsonify does, and prints the pages encoded per second
+
+        python benchmarks/json_encoding.py --page-sizes 10 100 --number 2000
+'''
+import argparse
+import json
+import os
+import random
+import sys
+import timeit
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from flask.json import JSONEncoder  # noqa: E402
+
+from serialization.encoders import IsoDateJSONEncoder, \
+    orjson_encoder  # noqa: E402
+
+ENCODERS = [
+    ('stdlib, http dates', JSONEncoder),
+    ('stdlib, iso dates', IsoDateJSONEncoder),
+    ('orjson, http dates', orjson_encoder('http')),
+    ('orjson, iso dates', orjson_encoder('iso')),
+]
+
+
+def movies_page(size, rng):
+    return {
+        'success': True,
+        'movies': [{
+            'id': movie_id,
+            'title': f'Movie {movie_id}',
+            'release_date': date(1950, 1, 1) + timedelta(
+                days=rng.randint(0, 25000)),
+            'actors': [f'Actor {rng.randint(1, 10000)}'
+                       for _ in range(rng.randint(1, 8))]
+        } for movie_id in range(1, size + 1)],
+        'next_cursor': 'WzEwXQ'
+    }
+
+
+def actors_page(size, rng):
+    return {
+        'success': True,
+        'actors': [{
+            'id': actor_id,
+            'name': f'Actor {actor_id}',
+            'age': rng.randint(18, 80),
+            'gender': rng.choice(['male', 'female']),
+            'movies': [f'Movie {rng.randint(1, 10000)}'
+                       for _ in range(rng.randint(1, 20))]
+        } for actor_id in range(1, size + 1)]
+    }
+
+
+def encode(encoder, page):
+    # The arguments of flask.json.dumps in jsonify (compact, sorted keys)
+    return json.dumps(page, cls=encoder, separators=(',', ':'),
+                      sort_keys=True)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Compare the JSON encoders on list pages.')
+    parser.add_argument('--page-sizes', type=int, nargs='+',
+                        default=[10, 100])
+    parser.add_argument('--number', type=int, default=2000,
+                        help='pages encoded per measure')
+    parser.add_argument('--repeat', type=int, default=5)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    rng = random.Random(0)
+
+    print(f'{"page":<12}{"encoder":<22}{"pages/s":>12}{"speedup":>9}')
+    for size in args.page_sizes:
+        for label, page in [(f'movies/{size}', movies_page(size, rng)),
+                            (f'actors/{size}', actors_page(size, rng))]:
+            reference = None
+            for name, encoder in ENCODERS:
+                best = min(timeit.repeat(lambda: encode(encoder, page),
+                                         number=args.number,
+                                         repeat=args.repeat))
+                rate = args.number / best
+                reference = reference or rate
+                print(f'{label:<12}{name:<22}{rate:>12,.0f}'
+                      f'{rate / reference:>8.1f}x')
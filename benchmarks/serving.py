@@ -0,0 +1,121 @@
+'''
+Serving mode benchmark
+    starts the API under the Procfile setup (`gunicorn app:app`, sync
+    workers) and under the cooperative mode (async_app, gevent worker),
+    drives each with `concurrency` clients for `duration` seconds and
+    prints the throughput and latency percentiles side by side
+
+        python benchmarks/serving.py --path /movies --concurrency 10 100 1000
+
+    the server reads the usual environment (DB_URI, AUTH0_DOMAIN, ...) and
+    the clients send TOKEN_CASTING_ASSISTANT as bearer token
+'''
+from gevent import monkey
+monkey.patch_all()
+
+import argparse  # noqa: E402
+import os  # noqa: E402
+import socket  # noqa: E402
+import subprocess  # noqa: E402
+import sys  # noqa: E402
+import time  # noqa: E402
+from urllib.error import HTTPError, URLError  # noqa: E402
+from urllib.request import Request, urlopen  # noqa: E402
+
+import gevent  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODES = {
+    'sync': ['app:app'],
+    'gevent': ['-k', 'gevent', '--worker-connections', '10000',
+               'async_app:app'],
+}
+
+
+def start_server(mode, port, workers):
+    command = ['gunicorn', '--bind', f'127.0.0.1:{port}',
+               '--workers', str(workers), '--log-level', 'warning']
+    server = subprocess.Popen(command + MODES[mode], cwd=ROOT)
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return server
+        except OSError:
+            if server.poll() is not None:
+                break
+            time.sleep(0.2)
+    server.kill()
+    sys.exit(f'{mode} server did not start')
+
+
+def percentile(latencies, fraction):
+    if not latencies:
+        return 0.0
+    return latencies[min(int(len(latencies) * fraction), len(latencies) - 1)]
+
+
+def drive(url, token, concurrency, duration):
+    latencies = []
+    errors = [0]
+    stop_at = time.monotonic() + duration
+
+    def client():
+        request = Request(url, headers={'Authorization': f'Bearer {token}'})
+        while time.monotonic() < stop_at:
+            started = time.perf_counter()
+            try:
+                with urlopen(request, timeout=60) as response:
+                    response.read()
+                latencies.append(time.perf_counter() - started)
+            except (HTTPError, URLError, OSError):
+                errors[0] += 1
+
+    gevent.joinall([gevent.spawn(client) for _ in range(concurrency)])
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'throughput': len(latencies) / duration,
+        'p50': percentile(latencies, 0.50) * 1000,
+        'p99': percentile(latencies, 0.99) * 1000
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Compare the sync and gevent serving modes.')
+    parser.add_argument('--path', default='/movies')
+    parser.add_argument('--concurrency', type=int, nargs='+',
+                        default=[10, 100, 1000])
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='gunicorn workers, for both modes')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--modes', nargs='+', default=list(MODES),
+                        choices=list(MODES))
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    token = os.getenv('TOKEN_CASTING_ASSISTANT')
+    if not token:
+        sys.exit('TOKEN_CASTING_ASSISTANT is not set.')
+    url = f'http://127.0.0.1:{args.port}{args.path}'
+
+    print(f'{"mode":<8}{"clients":>8}{"requests":>10}{"errors":>8}'
+          f'{"req/s":>10}{"p50 ms":>10}{"p99 ms":>10}')
+    for mode in args.modes:
+        server = start_server(mode, args.port, args.workers)
+        try:
+            for concurrency in args.concurrency:
+                result = drive(url, token, concurrency, args.duration)
+                print(f'{mode:<8}{concurrency:>8}{result["requests"]:>10}'
+                      f'{result["errors"]:>8}{result["throughput"]:>10.1f}'
+                      f'{result["p50"]:>10.1f}{result["p99"]:>10.1f}')
+        finally:
+            server.terminate()
+            server.wait()
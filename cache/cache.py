@@ -0,0 +1,220 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+'''
+Response cache backends
+    a backend stores bytes under string keys with get / set / delete, and
+    integer counters with incr:
+    - LRUBackend: in-process, bounded by size and TTL
+    - RedisBackend: any client with the redis-py get / set(ex=) / delete
+    API, so it can run against Redis or a local stand-in
+    - NullBackend: disables the cache
+'''
+
+
+class LRUBackend:
+    def __init__(self, max_size=1024, ttl=60, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires_at, value = entry
+            if self.clock() >= expires_at:
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (self.clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def incr(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            value = 1
+            if entry is not None and self.clock() < entry[0]:
+                value = int(entry[1]) + 1
+            self._entries[key] = (self.clock() + self.ttl,
+                                  str(value).encode('ascii'))
+            self._entries.move_to_end(key)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisBackend:
+    def __init__(self, client, ttl=60, prefix='casting:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, value, ex=self.ttl)
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+    def incr(self, key):
+        value = self.client.incr(self.prefix + key)
+        self.client.expire(self.prefix + key, self.ttl)
+        return value
+
+    def clear(self):
+        pass
+
+
+class NullBackend:
+    def get(self, key):
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, *keys):
+        pass
+
+    def incr(self, key):
+        return 0
+
+    def clear(self):
+        pass
+
+
+'''
+ResponseCache
+    keeps the serialized body of a response with its ETag. The cache is
+    read-through: the routes fill it on a miss and invalidate the keys of
+    every row a write changes. Backend errors are counted and treated as
+    misses, so a cache outage does not take the API down
+
+    every invalidation of a key increments its generation. A fill passes
+    the generation read before loading the body, and is dropped if the key
+    was invalidated since: a reader that loaded the row before a write
+    cannot put it back after the write has invalidated it
+'''
+
+
+class ResponseCache:
+    def __init__(self, backend):
+        self.backend = backend
+
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def get(self, key):
+        try:
+            value = self.backend.get(key)
+        except Exception:
+            self._count('errors')
+            value = None
+
+        if value is None:
+            self._count('misses')
+            return None
+
+        self._count('hits')
+        etag, body = value.split(b'\n', 1)
+        return etag.decode('ascii'), body
+
+    def generation(self, key):
+        try:
+            return int(self.backend.get(generation_key(key)) or 0)
+        except Exception:
+            self._count('errors')
+            return None
+
+    def set(self, key, etag, body, generation=None):
+        try:
+            self.backend.set(key, etag.encode('ascii') + b'\n' + body)
+            # Checked after the write: an invalidation either changed the
+            # generation first, or deletes the entry after it
+            if generation is not None and \
+                    self.generation(key) != generation:
+                self.backend.delete(key)
+        except Exception:
+            self._count('errors')
+
+    def invalidate(self, *keys):
+        try:
+            for key in keys:
+                self.backend.incr(generation_key(key))
+            self.backend.delete(*keys)
+        except Exception:
+            self._count('errors')
+
+    def clear(self):
+        self.backend.clear()
+
+
+def movie_key(movie_id):
+    return f'movie:{movie_id}'
+
+
+def actor_key(actor_id):
+    return f'actor:{actor_id}'
+
+
+def generation_key(key):
+    return f'generation:{key}'
+
+
+'''
+backend_from_env()
+    RESPONSE_CACHE_BACKEND is 'memory' (default), 'redis' (client built
+    from RESPONSE_CACHE_URL, requires the redis package) or 'none'
+
+    the memory cache is per process: a write only invalidates it in the
+    process that served the write, and the others keep serving the old
+    body for up to RESPONSE_CACHE_TTL seconds. Use 'redis' with several
+    workers (gunicorn.conf.py turns the default off for more than one)
+'''
+
+
+def backend_from_env():
+    name = os.getenv('RESPONSE_CACHE_BACKEND', 'memory')
+    ttl = int(os.getenv('RESPONSE_CACHE_TTL', 60))
+
+    if name == 'none':
+        return NullBackend()
+    if name == 'redis':
+        import redis
+        client = redis.Redis.from_url(os.getenv('RESPONSE_CACHE_URL'))
+        return RedisBackend(client, ttl=ttl)
+    return LRUBackend(max_size=int(os.getenv('RESPONSE_CACHE_SIZE', 1024)),
+                      ttl=ttl)
+
+
+response_cache = ResponseCache(backend_from_env())
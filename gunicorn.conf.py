@@ -0,0 +1,38 @@
+import os
+import shutil
+
+'''
+Gunicorn settings
+    with PROMETHEUS_MULTIPROC_DIR set, every worker writes its metrics to
+    files in that directory, aggregated by GET /metrics. The directory is
+    emptied when the server starts, and the files of a worker are merged
+    into the totals when it exits
+
+    the in-process response cache is not shared between workers, so it is
+    only the default with a single worker: set RESPONSE_CACHE_BACKEND=redis
+    to cache responses with more
+'''
+multiproc_dir = os.getenv('PROMETHEUS_MULTIPROC_DIR') or \
+    os.getenv('prometheus_multiproc_dir')
+
+if multiproc_dir:
+    # prometheus_client reads the lowercase name before 0.10
+    os.environ['prometheus_multiproc_dir'] = multiproc_dir
+
+
+def on_starting(server):
+    if multiproc_dir:
+        shutil.rmtree(multiproc_dir, ignore_errors=True)
+        os.makedirs(multiproc_dir)
+
+    if server.cfg.workers > 1 and not os.getenv('RESPONSE_CACHE_BACKEND'):
+        # Before the workers are forked (and after the app, with --preload)
+        os.environ['RESPONSE_CACHE_BACKEND'] = 'none'
+        from cache.cache import NullBackend, response_cache
+        response_cache.backend = NullBackend()
+
+
+def child_exit(server, worker):
+    if multiproc_dir:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -2,7 +2,7 @@ from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
 from app import app
-from models.models import db
+from models.models import db, reconcile_row_counts
 
 migrate = Migrate(app, db)
 manager = Manager(app)
@@ -10,5 +10,15 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+@manager.command
+def reconcile_counts():
+    '''Recount Movies and Actors and repair the row counters'''
+    for table_name, (counter, actual) in reconcile_row_counts().items():
+        if counter == actual:
+            print(f'{table_name}: {actual}')
+        else:
+            print(f'{table_name}: {counter} -> {actual} (repaired)')
+
+
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,184 @@
+import os
+import time
+from flask import Response, g, has_request_context, request
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, \
+    CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
+from sqlalchemy import event
+
+'''
+Metrics
+    Prometheus metrics of the API, rendered by GET /metrics:
+    - request latency per route, method and status
+    - per request: time spent in the database, in JSON serialization, and
+    number of SQL statements
+    - authentication time (token cache hit, verified, or failed)
+    - JWKS fetches and fetch errors
+    - admission control: time waited for a slot, and requests shed, per
+    route class (see admission)
+
+    under gunicorn, each worker writes its metrics to files in
+    PROMETHEUS_MULTIPROC_DIR (see gunicorn.conf.py), and /metrics
+    aggregates the files of all the workers
+'''
+SQL_STATEMENT_BUCKETS = [0, 1, 2, 3, 5, 10, 20, 50, 100, 200, float('inf')]
+
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'Time to serve a request',
+    ['route', 'method', 'status'])
+DB_TIME = Histogram(
+    'http_request_db_seconds', 'Time spent in SQL statements per request',
+    ['route'])
+SERIALIZATION_TIME = Histogram(
+    'http_request_serialization_seconds',
+    'Time spent encoding JSON per request', ['route'])
+SQL_STATEMENTS = Histogram(
+    'http_request_sql_statements', 'SQL statements executed per request',
+    ['route'], buckets=SQL_STATEMENT_BUCKETS)
+AUTH_TIME = Histogram(
+    'auth_duration_seconds', 'Time to authenticate a bearer token',
+    ['result'])
+JWKS_FETCHES = Counter(
+    'jwks_fetches_total', 'JWKS fetches from the identity provider',
+    ['result'])
+ADMISSION_WAIT = Histogram(
+    'admission_wait_seconds', 'Time a request waited for a slot',
+    ['route_class'])
+ADMISSION_SHED = Counter(
+    'admission_shed_total', 'Requests rejected with a 503 under overload',
+    ['route_class', 'reason'])
+
+
+def multiprocess_dir():
+    # prometheus_client reads the lowercase name before 0.10
+    return os.getenv('PROMETHEUS_MULTIPROC_DIR') or \
+        os.getenv('prometheus_multiproc_dir')
+
+
+def observe_auth(seconds, result):
+    AUTH_TIME.labels(result).observe(seconds)
+
+
+def observe_jwks_fetch(succeeded):
+    JWKS_FETCHES.labels('success' if succeeded else 'error').inc()
+
+
+def observe_admission_wait(route_class, seconds):
+    ADMISSION_WAIT.labels(route_class).observe(seconds)
+
+
+def observe_shed(route_class, reason):
+    ADMISSION_SHED.labels(route_class, reason).inc()
+
+
+def route_label():
+    # The rule rather than the path, so that ids do not explode the number
+    # of series
+    if request.url_rule is None:
+        return 'unmatched'
+    return request.url_rule.rule
+
+
+'''
+SQL statement timing
+    observe_statements(engine, observer) calls `observer(statement,
+    seconds)` after every statement the engine executes. One pair of
+    cursor listeners per engine times the statements for all the
+    observers (the metrics below, the profiler); the start time of a
+    statement that fails is dropped by the handle_error listener
+'''
+_statement_observers = []
+
+
+def observe_statements(engine, observer):
+    if observer not in _statement_observers:
+        _statement_observers.append(observer)
+    if not event.contains(engine, 'before_cursor_execute',
+                          _before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(engine, 'handle_error', _handle_error)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    elapsed = time.perf_counter() - conn.info['query_started'].pop()
+    for observer in _statement_observers:
+        observer(statement, elapsed)
+
+
+def _handle_error(context):
+    # A connection runs one statement at a time: nothing else is pending
+    if context.connection is not None:
+        context.connection.info.pop('query_started', None)
+
+
+'''
+Per-request measures
+    accumulated in flask.g by the SQL statement timing and the JSON
+    encoder, and observed when the request context is torn down (after a
+    streamed body has been sent)
+'''
+
+
+def _observe_request_statement(statement, seconds):
+    if has_request_context() and 'metrics_started' in g:
+        g.sql_statements += 1
+        g.db_seconds += seconds
+
+
+def timed_json_encoder(encoder):
+    class TimedJSONEncoder(encoder):
+        def encode(self, o):
+            started = time.perf_counter()
+            try:
+                return super().encode(o)
+            finally:
+                if has_request_context() and 'metrics_started' in g:
+                    g.serialization_seconds += \
+                        time.perf_counter() - started
+    return TimedJSONEncoder
+
+
+def init_metrics(app, engine):
+    app.json_encoder = timed_json_encoder(app.json_encoder)
+
+    observe_statements(engine, _observe_request_statement)
+
+    @app.before_request
+    def start_request_metrics():
+        g.metrics_started = time.perf_counter()
+        g.sql_statements = 0
+        g.db_seconds = 0.0
+        g.serialization_seconds = 0.0
+
+    @app.after_request
+    def record_status(response):
+        g.metrics_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def observe_request_metrics(error):
+        if 'metrics_started' not in g:
+            return
+        route = route_label()
+        status = g.get('metrics_status', 500)
+        REQUEST_LATENCY.labels(route, request.method, status).observe(
+            time.perf_counter() - g.metrics_started)
+        DB_TIME.labels(route).observe(g.db_seconds)
+        SERIALIZATION_TIME.labels(route).observe(g.serialization_seconds)
+        SQL_STATEMENTS.labels(route).observe(g.sql_statements)
+
+
+def metrics_response():
+    if multiprocess_dir():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry),
+                    content_type=CONTENT_TYPE_LATEST)
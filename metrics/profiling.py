@@ -0,0 +1,207 @@
+import base64
+import cProfile
+import json
+import marshal
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from flask import abort, g, has_request_context, jsonify, request
+
+from auth.auth import authenticate, check_permissions
+from metrics.metrics import observe_statements
+
+'''
+On-demand profiling
+    a request carrying `X-Profile: collapsed` or `X-Profile: pstats` from a
+    caller with the `profile:requests` permission runs under a profiler
+    (from authentication to the end of the view and its serialization),
+    and every SQL statement it executes is timed:
+    - collapsed: a sampling profiler (stack of the request thread every
+    PROFILE_SAMPLE_INTERVAL seconds), in the collapsed stack format of
+    flamegraph.pl / speedscope
+    - pstats: cProfile, in the format of the pstats module
+
+    with PROFILE_DIR set, the artifact is written there, with a .json
+    summary holding the SQL statements, and the response gets an
+    X-Profile-Id header; otherwise the response is replaced by the profile
+    (the pstats file is then base64 encoded)
+
+    a streamed response (the exports) is profiled until its body has been
+    sent, and the profile stored when PROFILE_DIR is set; without it, the
+    body is left as is and not profiled
+
+    a request without the header costs one header lookup
+'''
+PROFILE_HEADER = 'X-Profile'
+PROFILE_PERMISSION = 'profile:requests'
+PROFILE_FORMATS = ['collapsed', 'pstats']
+PROFILE_DIR = os.getenv('PROFILE_DIR')
+PROFILE_SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', 0.001))
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return f'{os.path.basename(code.co_filename)}:{code.co_name}'
+
+
+class StackSampler:
+    def __init__(self, thread_id, interval=PROFILE_SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n'
+                       for stack, count in self.stacks.most_common())
+
+
+class RequestProfile:
+    def __init__(self, output):
+        self.output = output
+        self.statements = []
+        self.duration = None
+        if output == 'pstats':
+            self.profiler = cProfile.Profile()
+        else:
+            self.profiler = StackSampler(threading.get_ident())
+
+    def start(self):
+        self.started = time.perf_counter()
+        if self.output == 'pstats':
+            self.profiler.enable()
+        else:
+            self.profiler.start()
+
+    def stop(self):
+        if self.output == 'pstats':
+            self.profiler.disable()
+        else:
+            self.profiler.stop()
+        self.duration = time.perf_counter() - self.started
+
+    def artifact(self):
+        if self.output == 'pstats':
+            self.profiler.create_stats()
+            return marshal.dumps(self.profiler.stats)
+        return self.profiler.collapsed().encode('utf-8')
+
+    def summary(self, status):
+        return {
+            'format': self.output,
+            'status': status,
+            'duration': self.duration,
+            'sql_seconds': sum(seconds for _, seconds in self.statements),
+            'sql': [{'statement': statement, 'seconds': seconds}
+                    for statement, seconds in self.statements]
+        }
+
+
+def _profile_statement(statement, seconds):
+    if has_request_context() and 'profile' in g:
+        g.profile.statements.append((statement, seconds))
+
+
+def new_profile_id():
+    return f'{int(time.time())}-{uuid.uuid4().hex[:8]}'
+
+
+def store_profile(profile, status, profile_id=None):
+    profile_id = profile_id or new_profile_id()
+    extension = 'pstats' if profile.output == 'pstats' else 'collapsed'
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    with open(os.path.join(PROFILE_DIR, f'{profile_id}.{extension}'),
+              'wb') as artifact_file:
+        artifact_file.write(profile.artifact())
+    with open(os.path.join(PROFILE_DIR, f'{profile_id}.json'),
+              'w') as summary_file:
+        json.dump(dict(profile.summary(status), path=request.path),
+                  summary_file, indent=2)
+    return profile_id
+
+
+def init_profiling(app, engine):
+    observe_statements(engine, _profile_statement)
+
+    @app.before_request
+    def start_profile():
+        output = request.headers.get(PROFILE_HEADER)
+        if output is None:
+            return
+        if output not in PROFILE_FORMATS:
+            abort(400)
+
+        profile = RequestProfile(output)
+        profile.start()
+        g.profile = profile
+        try:
+            check_permissions(PROFILE_PERMISSION, authenticate())
+        except Exception:
+            profile.stop()
+            g.pop('profile')
+            raise
+
+    @app.after_request
+    def finish_profile(response):
+        if 'profile' not in g:
+            return response
+
+        if response.is_streamed and PROFILE_DIR:
+            # The body is produced after this: stored by teardown
+            g.profile_stream = (new_profile_id(), response.status_code)
+            response.headers['X-Profile-Id'] = g.profile_stream[0]
+            return response
+
+        profile = g.pop('profile')
+        profile.stop()
+        if response.is_streamed:
+            return response
+
+        if PROFILE_DIR:
+            response.headers['X-Profile-Id'] = store_profile(
+                profile, response.status_code)
+            return response
+
+        summary = profile.summary(response.status_code)
+        if profile.output == 'pstats':
+            summary['pstats'] = base64.b64encode(
+                profile.artifact()).decode('ascii')
+        else:
+            summary['collapsed'] = profile.artifact().decode('utf-8')
+        return jsonify({
+            'success': True,
+            'profile': summary
+        })
+
+    @app.teardown_request
+    def discard_profile(error):
+        # After a streamed body has been sent, or the view raised and
+        # after_request did not run
+        profile = g.pop('profile', None)
+        if profile is None:
+            return
+        profile.stop()
+        if 'profile_stream' in g:
+            profile_id, status = g.pop('profile_stream')
+            store_profile(profile, status, profile_id)
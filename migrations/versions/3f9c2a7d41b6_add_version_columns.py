@@ -0,0 +1,33 @@
+"""add version columns to movies and actors
+
+Revision ID: 3f9c2a7d41b6
+Revises: 
+Create Date: 2026-10-18 10:12:31.482913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f9c2a7d41b6'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # A database built by the app (db.create_all) already has the columns
+    inspector = sa.inspect(op.get_bind())
+    for table_name in ['movies', 'actors']:
+        columns = [column['name']
+                   for column in inspector.get_columns(table_name)]
+        if 'version' not in columns:
+            op.add_column(table_name, sa.Column(
+                'version', sa.Integer(), server_default='1',
+                nullable=False))
+
+
+def downgrade():
+    op.drop_column('actors', 'version')
+    op.drop_column('movies', 'version')
@@ -0,0 +1,54 @@
+"""add full-text search vectors to movies and actors
+
+Revision ID: 8b1e5d0c9a27
+Revises: 3f9c2a7d41b6
+Create Date: 2026-10-18 11:02:47.163520
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '8b1e5d0c9a27'
+down_revision = '3f9c2a7d41b6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # SQLite uses FTS5 tables instead, created by setup_db
+    bind = op.get_bind()
+    if bind.dialect.name != 'postgresql':
+        return
+
+    # A database built by the app (db.create_all) already has the columns
+    # and indexes: add what is missing, and fill the empty vectors
+    inspector = sa.inspect(bind)
+    for table_name, column in [('movies', 'title'), ('actors', 'name')]:
+        columns = [existing['name']
+                   for existing in inspector.get_columns(table_name)]
+        if 'search_vector' not in columns:
+            op.add_column(table_name, sa.Column(
+                'search_vector', postgresql.TSVECTOR(), nullable=True))
+        op.execute(f"UPDATE {table_name} "
+                   f"SET search_vector = to_tsvector('simple', {column}) "
+                   f"WHERE search_vector IS NULL")
+
+        index = f'ix_{table_name}_search_vector'
+        indexes = [existing['name']
+                   for existing in inspector.get_indexes(table_name)]
+        if index not in indexes:
+            op.create_index(index, table_name, ['search_vector'],
+                            postgresql_using='gin')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+
+    op.drop_index('ix_actors_search_vector', table_name='actors')
+    op.drop_index('ix_movies_search_vector', table_name='movies')
+    op.drop_column('actors', 'search_vector')
+    op.drop_column('movies', 'search_vector')
@@ -0,0 +1,45 @@
+"""add indexes for list filters, sorts and movies_actors lookups by movie
+
+Revision ID: c47a9e13f5d2
+Revises: 8b1e5d0c9a27
+Create Date: 2026-10-18 11:48:05.291734
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c47a9e13f5d2'
+down_revision = '8b1e5d0c9a27'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    ('ix_movies_actors_movie_id', 'movies_actors', ['movie_id', 'actor_id']),
+    ('ix_movies_title_id', 'movies', ['title', 'id']),
+    ('ix_movies_release_date_id', 'movies', ['release_date', 'id']),
+    ('ix_actors_name_id', 'actors', ['name', 'id']),
+    ('ix_actors_age_id', 'actors', ['age', 'id']),
+    ('ix_actors_gender_id', 'actors', ['gender', 'id']),
+]
+
+
+def upgrade():
+    # A database built by the app (db.create_all) already has the indexes
+    inspector = sa.inspect(op.get_bind())
+    for name, table_name, columns in INDEXES:
+        existing = [index['name']
+                    for index in inspector.get_indexes(table_name)]
+        if name not in existing:
+            op.create_index(name, table_name, columns)
+
+
+def downgrade():
+    op.drop_index('ix_actors_gender_id', table_name='actors')
+    op.drop_index('ix_actors_age_id', table_name='actors')
+    op.drop_index('ix_actors_name_id', table_name='actors')
+    op.drop_index('ix_movies_release_date_id', table_name='movies')
+    op.drop_index('ix_movies_title_id', table_name='movies')
+    op.drop_index('ix_movies_actors_movie_id', table_name='movies_actors')
@@ -0,0 +1,37 @@
+"""add row_counts, the maintained number of Movies and Actors
+
+Revision ID: e5a20b7c93d4
+Revises: c47a9e13f5d2
+Create Date: 2026-10-18 13:02:41.508219
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5a20b7c93d4'
+down_revision = 'c47a9e13f5d2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # A database built by the app (db.create_all) already has the table, and
+    # maybe its rows: create and fill only what is missing
+    bind = op.get_bind()
+    if 'row_counts' not in sa.inspect(bind).get_table_names():
+        op.create_table('row_counts',
+                        sa.Column('table_name', sa.String(), nullable=False),
+                        sa.Column('count', sa.Integer(), nullable=False),
+                        sa.PrimaryKeyConstraint('table_name'))
+    for table_name in ['movies', 'actors']:
+        op.execute(f"INSERT INTO row_counts (table_name, count) "
+                   f"SELECT '{table_name}', "
+                   f"(SELECT COUNT(*) FROM {table_name}) "
+                   f"WHERE NOT EXISTS (SELECT 1 FROM row_counts "
+                   f"WHERE table_name = '{table_name}')")
+
+
+def downgrade():
+    op.drop_table('row_counts')
@@ -0,0 +1,413 @@
+import os
+import threading
+import time
+from array import array
+from collections import Counter
+from sqlalchemy import select, text
+
+from models.models import movies_actors
+
+'''
+Co-star graph
+    Actors are connected through the Movies they share (movies_actors). The
+    graph is held in memory as two adjacency lists in CSR form, actor ->
+    movies and movie -> actors: integer arrays of `offsets`, indexed by id,
+    into `targets`, about 8 bytes per association plus 4 per id. It is
+    built with one scan of movies_actors at startup, and updated in place
+    by the writes of this process (set_cast, set_filmography, ...). The
+    changes are kept in an overlay merged on read, and folded into the
+    arrays once the overlay grows past COMPACT_RATIO of the associations
+
+    other processes see a change when their index is rebuilt, at most
+    COSTAR_INDEX_TTL seconds later (0: never). The rebuild of a stale index
+    runs in a background thread, and the queries keep reading the previous
+    arrays until the new ones are swapped in. With COSTAR_INDEX=false,
+    the queries run in the database instead (see costars_sql and
+    shortest_path_sql)
+'''
+COSTAR_INDEX = os.getenv('COSTAR_INDEX', 'true').lower() in \
+    ['1', 'true', 'yes']
+COSTAR_INDEX_TTL = int(os.getenv('COSTAR_INDEX_TTL', 300))
+# Upper bound of the degrees of separation searched by a path query
+COSTAR_MAX_DEPTH = int(os.getenv('COSTAR_MAX_DEPTH', 6))
+COMPACT_RATIO = 0.1
+COMPACT_MIN = 1024
+
+
+class Adjacency:
+    def __init__(self, offsets=None, targets=None):
+        self.offsets = offsets if offsets is not None else array('i', [0])
+        self.targets = targets if targets is not None else array('i')
+        self.added = {}
+        self.removed = {}
+        self.overlay_size = 0
+
+    @classmethod
+    def from_pairs(cls, sources, targets):
+        # Counting sort of the (source, target) pairs by source
+        size = max(sources, default=-1) + 2
+        offsets = array('i', bytes(4 * size))
+        for source in sources:
+            offsets[source + 1] += 1
+        for index in range(1, size):
+            offsets[index] += offsets[index - 1]
+
+        position = array('i', offsets)
+        sorted_targets = array('i', bytes(4 * len(targets)))
+        for source, target in zip(sources, targets):
+            sorted_targets[position[source]] = target
+            position[source] += 1
+        return cls(offsets, sorted_targets)
+
+    def base(self, node):
+        if node + 1 >= len(self.offsets):
+            return self.targets[0:0]
+        return self.targets[self.offsets[node]:self.offsets[node + 1]]
+
+    def neighbors(self, node):
+        targets = self.base(node)
+        added = self.added.get(node)
+        removed = self.removed.get(node)
+        if not added and not removed:
+            return targets
+        return [target for target in targets
+                if not removed or target not in removed] + \
+            sorted(added or ())
+
+    def add(self, node, target):
+        if target in self.removed.get(node, ()):
+            self.removed[node].discard(target)
+        elif target not in self.base(node):
+            self.added.setdefault(node, set()).add(target)
+        else:
+            return
+        self.overlay_size += 1
+
+    def discard(self, node, target):
+        if target in self.added.get(node, ()):
+            self.added[node].discard(target)
+        elif target in self.base(node):
+            self.removed.setdefault(node, set()).add(target)
+        else:
+            return
+        self.overlay_size += 1
+
+    def compacted(self):
+        sources = array('i')
+        targets = array('i')
+        last = max([len(self.offsets) - 2] + list(self.added))
+        for node in range(last + 1):
+            for target in self.neighbors(node):
+                sources.append(node)
+                targets.append(target)
+        return Adjacency.from_pairs(sources, targets)
+
+
+'''
+CoStarIndex
+    the in-memory graph. Reads, writes and the swap of rebuilt arrays hold
+    a lock; the scan of movies_actors and the build do not. A write is
+    applied after its transaction commits, and also recorded while a
+    rebuild runs: the records are replayed on the new arrays, so a write
+    the scan missed is not lost
+'''
+
+
+class CoStarIndex:
+    def __init__(self, ttl=COSTAR_INDEX_TTL, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self.movies = None
+        self.actors = None
+        self.built_at = None
+        self._lock = threading.RLock()
+        # The changes made while a rebuild runs (None: no rebuild)
+        self._pending = None
+        self._first_load = threading.Lock()
+
+    def load(self, engine):
+        if self._begin_rebuild():
+            self._rebuild(engine)
+
+    def _begin_rebuild(self):
+        with self._lock:
+            if self._pending is not None:
+                return False
+            self._pending = []
+            return True
+
+    def _rebuild(self, engine):
+        try:
+            actor_ids, movie_ids = self._scan(engine)
+            movies = Adjacency.from_pairs(actor_ids, movie_ids)
+            actors = Adjacency.from_pairs(movie_ids, actor_ids)
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+
+        with self._lock:
+            pending, self._pending = self._pending, None
+            self.movies = movies
+            self.actors = actors
+            self.built_at = self.clock()
+            for change, args in pending:
+                change(*args)
+
+    def _scan(self, engine):
+        actor_ids = array('i')
+        movie_ids = array('i')
+        with engine.connect() as connection:
+            result = connection.execution_options(
+                stream_results=True).execute(
+                    select([movies_actors.c.actor_id,
+                            movies_actors.c.movie_id]))
+            while True:
+                rows = result.fetchmany(10000)
+                if not rows:
+                    break
+                for actor_id, movie_id in rows:
+                    actor_ids.append(actor_id)
+                    movie_ids.append(movie_id)
+        return actor_ids, movie_ids
+
+    def is_loaded(self):
+        return self.movies is not None
+
+    def is_stale(self):
+        return not self.is_loaded() or (
+            self.ttl > 0 and self.clock() - self.built_at >= self.ttl)
+
+    def refresh(self, engine):
+        # Only the first load makes the caller wait; a stale index keeps
+        # serving while it is rebuilt in the background
+        if not self.is_stale():
+            return
+        if not self.is_loaded():
+            with self._first_load:
+                if not self.is_loaded():
+                    self.load(engine)
+        elif self._begin_rebuild():
+            threading.Thread(target=self._rebuild, args=(engine,),
+                             daemon=True).start()
+
+    def clear(self):
+        with self._lock:
+            self.movies = None
+            self.actors = None
+
+    def movies_of(self, actor_id):
+        return self.movies.neighbors(actor_id)
+
+    def actors_of(self, movie_id):
+        return self.actors.neighbors(movie_id)
+
+    '''
+    Incremental updates
+        no-ops until the index is loaded (the load reads the change, or
+        replays it when the scan started before the change)
+    '''
+
+    def _record(self, change, *args):
+        # Kept for the rebuild running, if any; True once the index is
+        # loaded and the change can be applied
+        if self._pending is not None:
+            self._pending.append((change, args))
+        return self.is_loaded()
+
+    def add_links(self, pairs):
+        with self._lock:
+            pairs = list(pairs)
+            if self._record(self.add_links, pairs):
+                self._apply(True, pairs)
+
+    def remove_links(self, pairs):
+        with self._lock:
+            pairs = list(pairs)
+            if self._record(self.remove_links, pairs):
+                self._apply(False, pairs)
+
+    def _apply(self, added, pairs):
+        for actor_id, movie_id in pairs:
+            if added:
+                self.movies.add(actor_id, movie_id)
+                self.actors.add(movie_id, actor_id)
+            else:
+                self.movies.discard(actor_id, movie_id)
+                self.actors.discard(movie_id, actor_id)
+        self._compact_if_needed()
+
+    def set_cast(self, movie_id, actor_ids):
+        with self._lock:
+            actor_ids = set(actor_ids)
+            if not self._record(self.set_cast, movie_id, actor_ids):
+                return
+            current = set(self.actors_of(movie_id))
+            self._apply(False, [(actor_id, movie_id)
+                                for actor_id in current - actor_ids])
+            self._apply(True, [(actor_id, movie_id)
+                               for actor_id in actor_ids - current])
+
+    def set_filmography(self, actor_id, movie_ids):
+        with self._lock:
+            movie_ids = set(movie_ids)
+            if not self._record(self.set_filmography, actor_id, movie_ids):
+                return
+            current = set(self.movies_of(actor_id))
+            self._apply(False, [(actor_id, movie_id)
+                                for movie_id in current - movie_ids])
+            self._apply(True, [(actor_id, movie_id)
+                               for movie_id in movie_ids - current])
+
+    def remove_movie(self, movie_id):
+        self.set_cast(movie_id, [])
+
+    def remove_actor(self, actor_id):
+        self.set_filmography(actor_id, [])
+
+    def _compact_if_needed(self):
+        edges = len(self.movies.targets)
+        for name in ['movies', 'actors']:
+            adjacency = getattr(self, name)
+            if adjacency.overlay_size > max(COMPACT_MIN,
+                                            edges * COMPACT_RATIO):
+                setattr(self, name, adjacency.compacted())
+
+    '''
+    Queries
+    '''
+
+    def costars(self, actor_id):
+        # {co-star id: number of shared Movies}
+        with self._lock:
+            shared = Counter()
+            for movie_id in self.movies_of(actor_id):
+                shared.update(self.actors_of(movie_id))
+            shared.pop(actor_id, None)
+            return shared
+
+    def shortest_path(self, source, target, max_depth=COSTAR_MAX_DEPTH):
+        # Bidirectional BFS over Actors, expanding the smaller frontier one
+        # level at a time. Returns the Actors and the Movies linking them
+        # (movies[i] links actors[i] and actors[i + 1]), or None
+        if source == target:
+            return [source], []
+
+        with self._lock:
+            # {actor: (actor one step closer to the side's root, movie)}
+            parents = [{source: None}, {target: None}]
+            seen_movies = [set(), set()]
+            frontiers = [[source], [target]]
+            depth = 0
+            while frontiers[0] and frontiers[1] and depth < max_depth:
+                side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+                visited, other = parents[side], parents[1 - side]
+                next_frontier = []
+                for actor_id in frontiers[side]:
+                    for movie_id in self.movies_of(actor_id):
+                        if movie_id in seen_movies[side]:
+                            continue
+                        seen_movies[side].add(movie_id)
+                        for costar_id in self.actors_of(movie_id):
+                            if costar_id in visited:
+                                continue
+                            visited[costar_id] = (actor_id, movie_id)
+                            if costar_id in other:
+                                return _join_paths(parents, costar_id)
+                            next_frontier.append(costar_id)
+                frontiers[side] = next_frontier
+                depth += 1
+            return None
+
+
+def _join_paths(parents, meeting_id):
+    actors = [meeting_id]
+    movies = []
+    # Back to the source...
+    step = parents[0][meeting_id]
+    while step is not None:
+        actors.insert(0, step[0])
+        movies.insert(0, step[1])
+        step = parents[0][step[0]]
+    # ...and on to the target
+    step = parents[1][meeting_id]
+    while step is not None:
+        actors.append(step[0])
+        movies.append(step[1])
+        step = parents[1][step[0]]
+    return actors, movies
+
+
+costar_index = CoStarIndex()
+
+
+'''
+costars_sql(connection, actor_id) / shortest_path_sql(connection, source,
+target, max_depth)
+    the same queries in the database, when the index is disabled. The path
+    query computes the distance of every Actor within `max_depth` of
+    `source` with a recursive CTE (UNION keeps one row per Actor and
+    depth), then walks back from `target` with one co-star query per
+    degree. It is meant as a fallback: its cost grows with the Actors
+    around `source`, where the index only visits the two frontiers
+'''
+COSTARS_SQL = text('''
+    SELECT other.actor_id, COUNT(*) AS shared
+    FROM movies_actors AS own
+    JOIN movies_actors AS other ON other.movie_id = own.movie_id
+    WHERE own.actor_id = :actor_id AND other.actor_id != :actor_id
+    GROUP BY other.actor_id
+''')
+
+DISTANCES_SQL = text('''
+    WITH RECURSIVE walk(actor_id, depth) AS (
+        SELECT CAST(:source AS INTEGER), 0
+        UNION
+        SELECT other.actor_id, walk.depth + 1
+        FROM walk
+        JOIN movies_actors AS own ON own.actor_id = walk.actor_id
+        JOIN movies_actors AS other ON other.movie_id = own.movie_id
+        WHERE walk.depth < :max_depth AND walk.actor_id != :target
+    ),
+    distances AS (
+        SELECT actor_id, MIN(depth) AS depth FROM walk GROUP BY actor_id
+    )
+    SELECT actor_id, depth FROM distances
+    WHERE depth <= (SELECT depth FROM distances WHERE actor_id = :target)
+''')
+
+LINKS_SQL = text('''
+    SELECT other.actor_id, other.movie_id
+    FROM movies_actors AS own
+    JOIN movies_actors AS other ON other.movie_id = own.movie_id
+    WHERE own.actor_id = :actor_id
+''')
+
+
+def costars_sql(connection, actor_id):
+    return Counter(dict(connection.execute(
+        COSTARS_SQL, actor_id=actor_id).fetchall()))
+
+
+def shortest_path_sql(connection, source, target,
+                      max_depth=COSTAR_MAX_DEPTH):
+    if source == target:
+        return [source], []
+
+    distances = dict(connection.execute(
+        DISTANCES_SQL, source=source, target=target,
+        max_depth=max_depth).fetchall())
+    if target not in distances:
+        return None
+
+    # Any co-star one step closer to the source is on a shortest path
+    actors = [target]
+    movies = []
+    for depth in range(distances[target] - 1, -1, -1):
+        links = connection.execute(LINKS_SQL, actor_id=actors[0])
+        actor_id, movie_id = next(
+            (costar_id, movie_id) for costar_id, movie_id in links
+            if distances.get(costar_id) == depth)
+        actors.insert(0, actor_id)
+        movies.insert(0, movie_id)
+    return actors, movies
@@ -1,10 +1,20 @@
 import os
-from sqlalchemy import Column, String, Integer, Date, create_engine
+import hashlib
+from sqlalchemy import Column, String, Integer, Date, create_engine, \
+    bindparam, func, literal_column, select, tuple_
+from sqlalchemy.dialects import postgresql
+from sqlalchemy import Index, inspect
+from sqlalchemy.orm import deferred, joinedload, lazyload, load_only, \
+    selectinload, subqueryload
 from flask_sqlalchemy import SQLAlchemy
 import json
 from flask_migrate import Migrate
 from dotenv import load_dotenv
 
+from models.search import SearchVector, index_row, unindex_row, \
+    setup_search, sync_search_index
+from models.pool import engine_options, watch_engine
+
 
 load_dotenv()
 
@@ -21,12 +31,234 @@ setup_db(app)
 def setup_db(app, database_path=database_path):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
     db.app = app
     db.init_app(app)
+    watch_engine(db.engine)
     db.create_all()
+    setup_search(db.engine, [(Movie.__table__, Movie.__table__.c.title),
+                             (Actor.__table__, Actor.__table__.c.name)])
+    reconcile_row_counts(missing_only=True)
     migrate = Migrate(app, db)
 
 
+'''
+Relationship loading strategies
+    the movies_actors relationships are lazy by default, so that write paths
+    do not load collections they do not need. Read paths pick a strategy
+    per call site:
+    - 'selectin': one extra SELECT ... WHERE id IN (...) for the whole page
+    - 'joined': a single LEFT OUTER JOIN over movies_actors
+    - 'subquery': one extra SELECT re-running the parent query as subquery
+    - 'lazy': one SELECT per parent row when the collection is accessed
+'''
+LOADING_STRATEGIES = {
+    'selectin': selectinload,
+    'joined': joinedload,
+    'subquery': subqueryload,
+    'lazy': lazyload
+}
+
+
+def load_relationship(query, relationship, strategy='selectin'):
+    if strategy not in LOADING_STRATEGIES:
+        raise ValueError(f'Unknown loading strategy: {strategy}')
+    return query.options(LOADING_STRATEGIES[strategy](relationship))
+
+
+'''
+query_fieldset(model, fields, include, columns)
+    a query of `model` loading only the `fields` columns (all of them when
+    None), the id and version (ETag) and the `columns` (keyset cursors).
+    The relationships in `include` are loaded with one SELECT ... IN, with
+    the id, version and search column (the title / name listed by format())
+    of the related rows; the others are not loaded
+'''
+
+
+def query_fieldset(model, fields, include, columns=()):
+    if fields is None:
+        fields = model.fields
+    attributes = [getattr(model, field) for field in fields]
+    query = model.query.options(
+        load_only(*set(attributes + [model.id, model.version] +
+                       list(columns))))
+
+    for name in include:
+        relationship = getattr(model, name)
+        related = relationship.property.mapper.class_
+        query = query.options(selectinload(relationship).load_only(
+            related.id, related.version,
+            getattr(related, related.search_column)))
+    return query
+
+
+'''
+bulk_write(model, rows, upsert=False)
+    writes a list of column dicts with multi-row INSERTs, `chunk_size` rows
+    per statement, without committing (the caller owns the transaction).
+    With `upsert`, rows carrying an `id` replace the existing row: through
+    INSERT ... ON CONFLICT (id) DO UPDATE on PostgreSQL, and through a
+    batched UPDATE of the ids found by a single IN query elsewhere
+'''
+
+
+def bulk_write(model, rows, upsert=False, chunk_size=1000):
+    table = model.__table__
+    session = db.session
+    is_postgresql = session.bind.dialect.name == 'postgresql'
+    explicit_ids = any('id' in row for row in rows)
+    last_id = session.execute(select([func.max(table.c.id)])).scalar() or 0
+    inserted = 0
+    # Explicit ids do not advance the PostgreSQL serial sequence: it is
+    # moved past them before the next rows without an id are inserted
+    sequence_behind = False
+
+    def insert_without_id(without_id):
+        nonlocal sequence_behind
+        if sequence_behind:
+            _sync_sequence(session, table)
+            sequence_behind = False
+        session.execute(table.insert().values(without_id))
+
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+
+        if upsert and is_postgresql:
+            # Multi-row VALUES need every row to have the same columns
+            with_id = [row for row in chunk if 'id' in row]
+            without_id = [row for row in chunk if 'id' not in row]
+            if with_id:
+                statement = postgresql.insert(table).values(with_id)
+                statement = statement.on_conflict_do_update(
+                    index_elements=[table.c.id],
+                    set_=dict({column: statement.excluded[column]
+                               for column in with_id[0] if column != 'id'},
+                              version=table.c.version + 1))
+                # xmax is 0 on the rows that were inserted, not updated
+                result = session.execute(
+                    statement.returning(literal_column('xmax = 0')))
+                inserted += sum(1 for (new,) in result if new)
+                sequence_behind = True
+            if without_id:
+                insert_without_id(without_id)
+                inserted += len(without_id)
+            continue
+
+        inserts = chunk
+        if upsert and explicit_ids:
+            ids = [row['id'] for row in chunk if 'id' in row]
+            existing = set(
+                id for (id,) in session.execute(
+                    select([table.c.id]).where(table.c.id.in_(ids))))
+            updates = [row for row in chunk if row.get('id') in existing]
+            inserts = [row for row in chunk if row.get('id') not in existing]
+            if updates:
+                columns = [column for column in updates[0] if column != 'id']
+                session.execute(
+                    table.update()
+                    .where(table.c.id == bindparam('_id'))
+                    .values(dict({column: bindparam(column)
+                                  for column in columns},
+                                 version=table.c.version + 1)),
+                    [dict(row, _id=row['id']) for row in updates])
+
+        with_id = [row for row in inserts if 'id' in row]
+        without_id = [row for row in inserts if 'id' not in row]
+        if with_id:
+            session.execute(table.insert().values(with_id))
+            sequence_behind = is_postgresql
+        if without_id:
+            insert_without_id(without_id)
+        inserted += len(inserts)
+
+    adjust_row_count(table.name, inserted)
+    if sequence_behind:
+        _sync_sequence(session, table)
+
+    sync_search_index(session, table, table.c[model.search_column],
+                      ids=[row['id'] for row in rows if 'id' in row],
+                      after_id=last_id)
+
+    return len(rows)
+
+
+def _sync_sequence(session, table):
+    # The next id of the serial sequence: past the largest id in the table
+    session.execute(
+        select([func.setval(
+            func.pg_get_serial_sequence(table.name, 'id'),
+            select([func.coalesce(func.max(table.c.id), 0) + 1])
+            .as_scalar(),
+            False)]))
+
+
+'''
+Row counters
+    row_counts holds the number of rows of the counted tables, so that
+    totals do not need a COUNT(*) scan. It is updated in the same
+    transaction as the inserts and deletes (model write methods, bulk
+    writes, populator), and repaired by reconcile_row_counts
+    (`python manage.py reconcile_counts`)
+'''
+COUNTED_TABLES = ['movies', 'actors']
+
+row_counts = db.Table('row_counts',
+                      db.Column('table_name', db.String, primary_key=True),
+                      db.Column('count', db.Integer, nullable=False))
+
+
+def adjust_row_count(table_name, delta, executor=None):
+    if delta == 0:
+        return
+    (executor or db.session).execute(
+        row_counts.update()
+        .where(row_counts.c.table_name == table_name)
+        .values(count=row_counts.c.count + delta))
+
+
+def get_row_count(table_name):
+    count = db.session.execute(
+        select([row_counts.c.count])
+        .where(row_counts.c.table_name == table_name)).scalar()
+    if count is None:
+        count = reconcile_row_counts([table_name])[table_name][1]
+    return count
+
+
+'''
+reconcile_row_counts(table_names, missing_only=False)
+    recounts the tables and fixes their counter (only creates the missing
+    ones with `missing_only`), returns {table_name: (counter, actual count)}
+'''
+
+
+def reconcile_row_counts(table_names=COUNTED_TABLES, missing_only=False):
+    drift = {}
+    with db.engine.begin() as connection:
+        for table_name in table_names:
+            counter = connection.execute(
+                select([row_counts.c.count])
+                .where(row_counts.c.table_name == table_name)
+                .with_for_update()).scalar()
+            if counter is not None and missing_only:
+                continue
+
+            table = db.metadata.tables[table_name]
+            actual = connection.execute(
+                select([func.count()]).select_from(table)).scalar()
+            if counter is None:
+                connection.execute(row_counts.insert().values(
+                    table_name=table_name, count=actual))
+            elif counter != actual:
+                connection.execute(
+                    row_counts.update()
+                    .where(row_counts.c.table_name == table_name)
+                    .values(count=actual))
+            drift[table_name] = (counter, actual)
+    return drift
+
+
 '''
 Map actors and movies
 '''
@@ -36,6 +268,13 @@ movies_actors = db.Table('movies_actors',
                          db.Column('movie_id', db.Integer, db.ForeignKey(
                              'movies.id'), primary_key=True)
                          )
+# The primary key leads with actor_id, lookups by movie need their own index
+Index('ix_movies_actors_movie_id', movies_actors.c.movie_id,
+      movies_actors.c.actor_id)
+
+
+def make_etag(*parts):
+    return hashlib.sha1(json.dumps(parts).encode('utf-8')).hexdigest()
 
 
 '''
@@ -49,31 +288,66 @@ class Movie(db.Model):
     id = Column(Integer, primary_key=True)
     title = Column(String, nullable=False)
     release_date = Column(Date, nullable=False)
+    # Incremented by SQLAlchemy on every UPDATE of the row
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+    # Full-text index of the title (PostgreSQL only, see models.search)
+    search_vector = deferred(Column(SearchVector))
     actors = db.relationship('Actor', secondary=movies_actors, lazy=True,
                              backref=db.backref('movies', lazy=True))
 
+    search_column = 'title'
+    # Sparse fieldsets: the columns and relationships format() can return
+    fields = ['id', 'title', 'release_date']
+    relationships = ['actors']
+    __mapper_args__ = {'version_id_col': version}
+    __table_args__ = (Index('ix_movies_search_vector', 'search_vector',
+                            postgresql_using='gin'),
+                      # Filters and keyset sorts of the list route
+                      Index('ix_movies_title_id', 'title', 'id'),
+                      Index('ix_movies_release_date_id', 'release_date', 'id'))
+
     def __init__(self, title, release_date):
         self.title = title
         self.release_date = release_date
 
+    @classmethod
+    def query_with_actors(cls, strategy='selectin'):
+        return load_relationship(cls.query, cls.actors, strategy)
+
     def insert(self):
         db.session.add(self)
+        index_row(db.session, self, Movie.__table__, Movie.__table__.c.title)
+        adjust_row_count(Movie.__tablename__, 1)
         db.session.commit()
 
     def update(self):
+        if inspect(self).attrs.title.history.has_changes():
+            index_row(db.session, self, Movie.__table__,
+                      Movie.__table__.c.title)
         db.session.commit()
 
     def delete(self):
+        unindex_row(db.session, self.id, Movie.__table__)
+        adjust_row_count(Movie.__tablename__, -1)
         db.session.delete(self)
         db.session.commit()
 
-    def format(self):
-        return {
-            'id': self.id,
-            'title': self.title,
-            'release_date': self.release_date,
-            'actors': [actor.name for actor in self.actors]
-        }
+    def etag(self, fields=None, include=relationships):
+        # Identifies format() without building it: changes with the Movie,
+        # its cast, and the names of its Actors
+        cast = None
+        if 'actors' in include:
+            cast = sorted([actor.id, actor.version] for actor in self.actors)
+        return make_etag('movie', self.id, self.version, fields,
+                         list(include), cast)
+
+    def format(self, fields=None, include=relationships):
+        if fields is None:
+            fields = Movie.fields
+        body = {field: getattr(self, field) for field in fields}
+        if 'actors' in include:
+            body['actors'] = [actor.name for actor in self.actors]
+        return body
 
 
 '''
@@ -88,28 +362,155 @@ class Actor(db.Model):
     name = Column(String, nullable=False)
     age = Column(Integer, nullable=False)
     gender = Column(String, nullable=False)
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+    search_vector = deferred(Column(SearchVector))
+
+    search_column = 'name'
+    fields = ['id', 'name', 'age', 'gender']
+    relationships = ['movies']
+    __mapper_args__ = {'version_id_col': version}
+    __table_args__ = (Index('ix_actors_search_vector', 'search_vector',
+                            postgresql_using='gin'),
+                      Index('ix_actors_name_id', 'name', 'id'),
+                      Index('ix_actors_age_id', 'age', 'id'),
+                      Index('ix_actors_gender_id', 'gender', 'id'))
 
     def __init__(self, name, age, gender):
         self.name = name
         self.age = age
         self.gender = gender
 
+    @classmethod
+    def query_with_movies(cls, strategy='selectin'):
+        return load_relationship(cls.query, cls.movies, strategy)
+
     def insert(self):
         db.session.add(self)
+        index_row(db.session, self, Actor.__table__, Actor.__table__.c.name)
+        adjust_row_count(Actor.__tablename__, 1)
         db.session.commit()
 
     def update(self):
+        if inspect(self).attrs.name.history.has_changes():
+            index_row(db.session, self, Actor.__table__,
+                      Actor.__table__.c.name)
         db.session.commit()
 
     def delete(self):
+        unindex_row(db.session, self.id, Actor.__table__)
+        adjust_row_count(Actor.__tablename__, -1)
         db.session.delete(self)
         db.session.commit()
 
-    def format(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'age': self.age,
-            'gender': self.gender,
-            'movies': [movie.title for movie in self.movies]
-        }
+    def etag(self, fields=None, include=relationships):
+        filmography = None
+        if 'movies' in include:
+            filmography = sorted([movie.id, movie.version]
+                                 for movie in self.movies)
+        return make_etag('actor', self.id, self.version, fields,
+                         list(include), filmography)
+
+    def format(self, fields=None, include=relationships):
+        if fields is None:
+            fields = Actor.fields
+        body = {field: getattr(self, field) for field in fields}
+        if 'movies' in include:
+            body['movies'] = [movie.title for movie in self.movies]
+        return body
+
+
+'''
+cast_names(connection, movie_ids) / filmography_titles(connection, actor_ids)
+    the names of the Actors of each Movie (titles of the Movies of each
+    Actor) in a single query over movies_actors, as {id: [names]}. Used to
+    serialize many rows without going through the ORM relationships
+'''
+
+
+def _related_values(connection, key_column, value_column, join, ids):
+    related = {id: [] for id in ids}
+    if not ids:
+        return related
+
+    rows = connection.execute(
+        select([key_column, value_column])
+        .select_from(join)
+        .where(key_column.in_(ids)))
+    for key, value in rows:
+        related[key].append(value)
+    return related
+
+
+def cast_names(connection, movie_ids):
+    return _related_values(
+        connection, movies_actors.c.movie_id, Actor.__table__.c.name,
+        movies_actors.join(Actor.__table__), movie_ids)
+
+
+def filmography_titles(connection, actor_ids):
+    return _related_values(
+        connection, movies_actors.c.actor_id, Movie.__table__.c.title,
+        movies_actors.join(Movie.__table__), actor_ids)
+
+
+'''
+actor_ids_of_movies(movie_ids) / movie_ids_of_actors(actor_ids)
+    the IDs on the other side of movies_actors, read from the association
+    table only
+'''
+
+
+def actor_ids_of_movies(movie_ids):
+    return set(id for (id,) in db.session.execute(
+        select([movies_actors.c.actor_id])
+        .where(movies_actors.c.movie_id.in_(movie_ids))))
+
+
+def movie_ids_of_actors(actor_ids):
+    return set(id for (id,) in db.session.execute(
+        select([movies_actors.c.movie_id])
+        .where(movies_actors.c.actor_id.in_(actor_ids))))
+
+
+'''
+existing_ids(model, ids)
+    the `ids` that have a row, read from the primary key index
+'''
+
+
+def existing_ids(model, ids):
+    return set(id for (id,) in db.session.execute(
+        select([model.__table__.c.id])
+        .where(model.__table__.c.id.in_(ids))))
+
+
+'''
+add_links(pairs) / remove_links(pairs)
+    insert / delete (actor_id, movie_id) rows of movies_actors in one
+    statement, in the current transaction, without loading the
+    relationships. Links that already exist are skipped (ON CONFLICT DO
+    NOTHING on PostgreSQL, INSERT OR IGNORE elsewhere). Return the number
+    of rows inserted / deleted
+'''
+
+
+def add_links(pairs):
+    if not pairs:
+        return 0
+    rows = [{'actor_id': actor_id, 'movie_id': movie_id}
+            for actor_id, movie_id in pairs]
+    if db.session.bind.dialect.name == 'postgresql':
+        statement = postgresql.insert(movies_actors).values(rows)\
+            .on_conflict_do_nothing()
+    else:
+        statement = movies_actors.insert().values(rows)\
+            .prefix_with('OR IGNORE')
+    return db.session.execute(statement).rowcount
+
+
+def remove_links(pairs):
+    if not pairs:
+        return 0
+    return db.session.execute(movies_actors.delete().where(
+        tuple_(movies_actors.c.actor_id, movies_actors.c.movie_id)
+        .in_(list(pairs)))).rowcount
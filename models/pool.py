@@ -0,0 +1,199 @@
+import os
+import threading
+import time
+from sqlalchemy import event, exc
+from sqlalchemy.pool import NullPool, QueuePool
+
+'''
+Connection pool settings (environment variables)
+    DB_POOL_MODE            queue (default): a pool of connections kept
+                            open by each process
+                            pgbouncer: no pool in the app (NullPool), for
+                            pgbouncer in transaction pooling mode; session
+                            settings are applied per transaction
+    DB_POOL_SIZE            connections kept open (default 5)
+    DB_MAX_OVERFLOW         connections opened above DB_POOL_SIZE under load
+                            (default 10)
+    DB_POOL_TIMEOUT         seconds to wait for a connection (default 30)
+    DB_POOL_RECYCLE         seconds after which a connection is replaced
+                            (default -1, never)
+    DB_POOL_PRE_PING        test connections on checkout, to survive
+                            failovers and server-side timeouts (default true)
+    DB_STATEMENT_TIMEOUT    PostgreSQL statement_timeout, in milliseconds
+                            (default 0, none)
+'''
+POOL_MODES = ['queue', 'pgbouncer']
+
+
+def _env_bool(name, default):
+    return os.getenv(name, str(default)).lower() in ['1', 'true', 'yes']
+
+
+'''
+PoolStats
+    checkouts and timeouts of the pool, and a histogram of the time spent
+    waiting for a connection (cumulative counts of the waits under each
+    bound, in seconds)
+'''
+WAIT_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10]
+
+
+class PoolStats:
+    def __init__(self, buckets=WAIT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.checked_out = 0
+            self.checkouts = 0
+            self.timeouts = 0
+            self.wait_counts = [0] * (len(self.buckets) + 1)
+            self.wait_sum = 0.0
+
+    def observe_checkout(self, wait):
+        with self._lock:
+            self.checked_out += 1
+            self.checkouts += 1
+            self.wait_sum += wait
+            for index, bound in enumerate(self.buckets):
+                if wait <= bound:
+                    self.wait_counts[index] += 1
+                    break
+            else:
+                self.wait_counts[-1] += 1
+
+    def observe_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def observe_checkin(self):
+        with self._lock:
+            self.checked_out -= 1
+
+    def histogram(self):
+        with self._lock:
+            counts = list(self.wait_counts)
+            total = self.wait_sum
+        cumulative = []
+        running = 0
+        for bound, count in zip(self.buckets + ['+Inf'], counts):
+            running += count
+            cumulative.append([bound, running])
+        return {'buckets': cumulative, 'count': running, 'sum': total}
+
+
+pool_stats = PoolStats()
+
+
+class TimedPool:
+    # Mixin timing _do_get, the step where a checkout waits for (or opens)
+    # a connection; recreate() keeps the class, so it survives failovers
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            pool_stats.observe_timeout()
+            raise
+        pool_stats.observe_checkout(time.perf_counter() - started)
+        return connection
+
+    def _do_return_conn(self, conn):
+        pool_stats.observe_checkin()
+        super()._do_return_conn(conn)
+
+
+class TimedQueuePool(TimedPool, QueuePool):
+    pass
+
+
+class TimedNullPool(TimedPool, NullPool):
+    pass
+
+
+def pool_mode():
+    mode = os.getenv('DB_POOL_MODE', 'queue')
+    if mode not in POOL_MODES:
+        raise ValueError(f'Unknown DB_POOL_MODE: {mode}')
+    return mode
+
+
+def statement_timeout():
+    return int(os.getenv('DB_STATEMENT_TIMEOUT', 0))
+
+
+'''
+engine_options(database_uri)
+    the SQLALCHEMY_ENGINE_OPTIONS built from the environment
+'''
+
+
+def engine_options(database_uri):
+    database_uri = database_uri or ''
+    if database_uri.startswith('sqlite'):
+        # SQLite file databases are not pooled; in-memory ones keep their
+        # single connection pool
+        if database_uri in ['sqlite://', 'sqlite:///:memory:']:
+            return {}
+        return {'poolclass': TimedNullPool}
+
+    if pool_mode() == 'pgbouncer':
+        return {'poolclass': TimedNullPool}
+
+    options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': int(os.getenv('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', -1)),
+        'pool_pre_ping': _env_bool('DB_POOL_PRE_PING', True)
+    }
+    if statement_timeout() and database_uri.startswith('postgres'):
+        options['connect_args'] = {
+            'options': f'-c statement_timeout={statement_timeout()}'}
+    return options
+
+
+def _set_local_statement_timeout(connection):
+    cursor = connection.connection.cursor()
+    cursor.execute(f'SET LOCAL statement_timeout = {statement_timeout()}')
+    cursor.close()
+
+
+def watch_engine(engine):
+    # pgbouncer (transaction pooling) rejects the `options` startup
+    # parameter and shares server connections between clients, so the
+    # timeout is set at the start of every transaction instead
+    if engine.dialect.name != 'postgresql' or not statement_timeout():
+        return
+    if pool_mode() != 'pgbouncer':
+        return
+    if not event.contains(engine, 'begin', _set_local_statement_timeout):
+        event.listen(engine, 'begin', _set_local_statement_timeout)
+
+
+'''
+pool_status(engine)
+    the current state of the pool of `engine` and its statistics
+'''
+
+
+def pool_status(engine):
+    pool = engine.pool
+    status = {
+        'mode': pool_mode(),
+        'pool': type(pool).__name__,
+        'checked_out': pool_stats.checked_out,
+        'checkouts': pool_stats.checkouts,
+        'timeouts': pool_stats.timeouts,
+        'wait_seconds': pool_stats.histogram()
+    }
+    if isinstance(pool, QueuePool):
+        status.update({
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'overflow': max(pool.overflow(), 0)
+        })
+    return status
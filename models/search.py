@@ -0,0 +1,148 @@
+import re
+from sqlalchemy import Text, and_, func, or_, select, text
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.types import TypeDecorator
+
+'''
+Full-text search
+    on PostgreSQL, movies.title and actors.name are indexed in a tsvector
+    `search_vector` column with a GIN index (see the migrations), matched
+    with plainto_tsquery and ranked with ts_rank. On SQLite (local and test
+    use), they are indexed in FTS5 tables (movies_fts, actors_fts) whose
+    rowid is the id of the row, ranked with bm25
+
+    the index is kept up to date by the model write methods (index_row /
+    unindex_row) and by the bulk writes (sync_search_index)
+'''
+SEARCH_CONFIG = 'simple'
+
+
+class SearchVector(TypeDecorator):
+    impl = Text
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':
+            return dialect.type_descriptor(TSVECTOR())
+        return dialect.type_descriptor(Text())
+
+
+def _fts_table(table):
+    return f'{table.name}_fts'
+
+
+def _dialect(executor):
+    # Works with a Session as well as a Connection
+    if hasattr(executor, 'dialect'):
+        return executor.dialect
+    return executor.bind.dialect
+
+
+def setup_search(engine, searchable):
+    if engine.dialect.name != 'sqlite':
+        return
+
+    with engine.begin() as connection:
+        for table, column in searchable:
+            fts_table = _fts_table(table)
+            connection.execute(text(
+                f'CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} '
+                f'USING fts5({column.name})'))
+            # Index the rows written while the FTS table did not exist
+            connection.execute(text(
+                f'INSERT INTO {fts_table} (rowid, {column.name}) '
+                f'SELECT id, {column.name} FROM {table.name} '
+                f'WHERE id NOT IN (SELECT rowid FROM {fts_table})'))
+
+
+def index_row(session, row, table, column):
+    dialect = _dialect(session).name
+    value = getattr(row, column.key)
+
+    if dialect == 'postgresql':
+        # Set before the flush, so it is part of the INSERT / UPDATE
+        row.search_vector = func.to_tsvector(SEARCH_CONFIG, value)
+    elif dialect == 'sqlite':
+        session.flush()
+        session.execute(
+            text(f'INSERT OR REPLACE INTO {_fts_table(table)} '
+                 f'(rowid, {column.name}) VALUES (:id, :value)'),
+            {'id': row.id, 'value': value})
+
+
+def unindex_row(session, row_id, table):
+    if _dialect(session).name == 'sqlite':
+        session.execute(
+            text(f'DELETE FROM {_fts_table(table)} WHERE rowid = :id'),
+            {'id': row_id})
+
+
+'''
+sync_search_index(session, table, column, ids, after_id)
+    re-indexes, in one statement, the rows whose id is in `ids` or greater
+    than `after_id` (the rows written by a bulk insert)
+'''
+
+
+def sync_search_index(session, table, column, ids=(), after_id=None):
+    conditions = []
+    if ids:
+        conditions.append(table.c.id.in_(list(ids)))
+    if after_id is not None:
+        conditions.append(table.c.id > after_id)
+    if not conditions:
+        return
+
+    dialect = _dialect(session).name
+    if dialect == 'postgresql':
+        session.execute(
+            table.update()
+            .where(or_(*conditions))
+            .values(search_vector=func.to_tsvector(SEARCH_CONFIG, column)))
+    elif dialect == 'sqlite':
+        rows = select([table.c.id, column]).where(or_(*conditions)).compile(
+            dialect=_dialect(session),
+            compile_kwargs={'literal_binds': True})
+        session.execute(text(
+            f'INSERT OR REPLACE INTO {_fts_table(table)} '
+            f'(rowid, {column.name}) {rows}'))
+
+
+'''
+ranked_ids(session, table, query, limit, after)
+    returns up to `limit` (id, rank) pairs matching `query`, best first,
+    starting after the (rank, id) position `after`
+'''
+
+
+def ranked_ids(session, table, query, limit, after=None):
+    dialect = _dialect(session).name
+
+    if dialect == 'postgresql':
+        tsquery = func.plainto_tsquery(SEARCH_CONFIG, query)
+        rank = func.ts_rank(table.c.search_vector, tsquery)
+        statement = select([table.c.id, rank]) \
+            .where(table.c.search_vector.op('@@')(tsquery))
+        if after is not None:
+            statement = statement.where(or_(
+                rank < after[0],
+                and_(rank == after[0], table.c.id > after[1])))
+        statement = statement.order_by(rank.desc(), table.c.id).limit(limit)
+        return [(id, rank) for id, rank in session.execute(statement)]
+
+    # SQLite FTS5: match every word of the query as a quoted term
+    terms = re.findall(r'\w+', query)
+    if not terms:
+        return []
+    fts_table = _fts_table(table)
+    seek = ''
+    params = {'query': ' '.join(f'"{term}"' for term in terms),
+              'limit': limit}
+    if after is not None:
+        seek = 'WHERE rank < :rank OR (rank = :rank AND id > :id)'
+        params.update(rank=after[0], id=after[1])
+    rows = session.execute(text(
+        f'SELECT id, rank FROM ('
+        f'SELECT rowid AS id, -bm25({fts_table}) AS rank FROM {fts_table} '
+        f'WHERE {fts_table} MATCH :query) {seek} '
+        f'ORDER BY rank DESC, id LIMIT :limit'), params)
+    return [(id, rank) for id, rank in rows]
@@ -1,16 +1,19 @@
 import os
 import sys
+import argparse
+import csv
+import io
+import time
+from multiprocessing import Pool
 from flask import Flask, request, jsonify, abort
-from sqlalchemy import exc
+from sqlalchemy import exc, func, select, text
 import json
 from faker import Faker
 import random
 
-from models.models import setup_db, Actor, Movie
-
-app = Flask(__name__)
-database_path = os.getenv(sys.argv[1])
-setup_db(app, database_path)
+from models.models import db, setup_db, adjust_row_count, Actor, Movie, \
+    movies_actors
+from models.search import sync_search_index
 
 
 fak = Faker()
@@ -39,23 +42,204 @@ def populate_movies():
     for i in range(21):
         Faker.seed(i+50)
         title = fak.sentence(nb_words=fak.random_int(1, 6))
-        release_date = fak.date()
+        release_date = fak.date_object()
 
         movie = Movie(title=title, release_date=release_date)
 
+        # Actors IDs go from 1 to 101, and an Actor can only be cast once
         nb_actors_of_movie = fak.random_int(1, 5)
-        j = 0
-        for j in range(nb_actors_of_movie):
-            actor_id = fak.pyint(0, 99)
-            actor = Actor.query.filter(Actor.id == actor_id).one()
-            movie.actors.append(actor)
+        actor_ids = random.Random(i).sample(range(1, 102),
+                                            nb_actors_of_movie)
+        movie.actors = Actor.query.filter(Actor.id.in_(actor_ids)).all()
 
         movie.insert()
 
 
+'''
+High-volume mode (--bulk)
+    rows are generated in chunks (optionally in several processes, each
+    chunk with its own seed so a run is reproducible), with explicit IDs
+    taken after the current maximum. Casts are drawn from the range of
+    the new Actor IDs (with --actors 0, from the IDs of the existing
+    Actors, which may have gaps), and every chunk is written in one
+    statement: COPY on PostgreSQL, executemany elsewhere, together with
+    the row counters. The search index of the new rows is then built with
+    one set-based statement
+'''
+
+
+def generate_actors(chunk):
+    start_id, count, seed = chunk
+    fake = Faker()
+    fake.seed_instance(seed)
+
+    rows = []
+    for actor_id in range(start_id, start_id + count):
+        if actor_id % 2 == 0:
+            gender = 'male'
+            name = fake.name_male()
+        else:
+            gender = 'female'
+            name = fake.name_female()
+        rows.append((actor_id, name, fake.random_int(18, 80), gender))
+    return rows
+
+
+def generate_movies(chunk):
+    start_id, count, seed, actor_ids, max_cast = chunk
+    fake = Faker()
+    fake.seed_instance(seed)
+    rng = random.Random(seed)
+
+    movies = []
+    cast = []
+    for movie_id in range(start_id, start_id + count):
+        title = fake.sentence(nb_words=fake.random_int(1, 6))
+        movies.append((movie_id, title, fake.date_object()))
+
+        nb_actors_of_movie = min(rng.randint(1, max_cast), len(actor_ids))
+        for actor_id in rng.sample(actor_ids, nb_actors_of_movie):
+            cast.append((actor_id, movie_id))
+    return movies, cast
+
+
+def write_rows(connection, table, columns, rows):
+
+    if connection.dialect.name == 'postgresql':
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(rows)
+        buffer.seek(0)
+        cursor = connection.connection.cursor()
+        cursor.copy_expert(
+            f'COPY {table.name} ({", ".join(columns)}) '
+            f'FROM STDIN WITH (FORMAT csv)', buffer)
+    else:
+        connection.execute(table.insert(),
+                           [dict(zip(columns, row)) for row in rows])
+
+
+def reset_sequence(connection, table):
+    if connection.dialect.name == 'postgresql':
+        with connection.begin():
+            connection.execute(
+                text("SELECT setval(pg_get_serial_sequence(:table, 'id'), "
+                     f"(SELECT COALESCE(MAX(id), 0) + 1 FROM {table}), "
+                     "false)"),
+                table=table)
+
+
+def chunks(start_id, total, chunk_size, seed):
+    for index, offset in enumerate(range(0, total, chunk_size)):
+        yield (start_id + offset, min(chunk_size, total - offset),
+               seed + index)
+
+
+def report(label, rows, started):
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    print(f'{rows} {label} in {elapsed:.1f}s ({rows / elapsed:,.0f} rows/s)')
+
+
+def populate_bulk(nb_actors, nb_movies, max_cast, chunk_size, workers,
+                  seed):
+    with db.engine.connect() as connection:
+        next_actor = connection.execute(
+            select([func.coalesce(func.max(Actor.id), 0)])).scalar() + 1
+        next_movie = connection.execute(
+            select([func.coalesce(func.max(Movie.id), 0)])).scalar() + 1
+
+        pool = Pool(workers) if workers > 1 else None
+        imap = pool.imap if pool else map
+        try:
+            print(f'Populating database with {nb_actors} fake Actors...')
+            started = time.perf_counter()
+            for rows in imap(generate_actors, chunks(
+                    next_actor, nb_actors, chunk_size, seed)):
+                with connection.begin():
+                    write_rows(connection, Actor.__table__,
+                               ['id', 'name', 'age', 'gender'], rows)
+                    adjust_row_count(Actor.__tablename__, len(rows),
+                                     connection)
+            reset_sequence(connection, Actor.__tablename__)
+            with connection.begin():
+                sync_search_index(connection, Actor.__table__,
+                                  Actor.__table__.c.name,
+                                  after_id=next_actor - 1)
+            report('actors', nb_actors, started)
+
+            if nb_actors:
+                actor_ids = range(next_actor, next_actor + nb_actors)
+            else:
+                # Deleted Actors leave gaps between min(id) and max(id)
+                actor_ids = [actor_id for actor_id, in connection.execute(
+                    select([Actor.id]).order_by(Actor.id))]
+            if nb_movies and not actor_ids:
+                sys.exit('Movies need Actors to be cast.')
+
+            print(f'Populating database with {nb_movies} fake Movies...')
+            started = time.perf_counter()
+            nb_cast = 0
+            movie_chunks = (
+                chunk + (actor_ids, max_cast)
+                for chunk in chunks(next_movie, nb_movies, chunk_size,
+                                    seed + 1000000))
+            for movies, cast in imap(generate_movies, movie_chunks):
+                with connection.begin():
+                    write_rows(connection, Movie.__table__,
+                               ['id', 'title', 'release_date'], movies)
+                    write_rows(connection, movies_actors,
+                               ['actor_id', 'movie_id'], cast)
+                    adjust_row_count(Movie.__tablename__, len(movies),
+                                     connection)
+                nb_cast += len(cast)
+            reset_sequence(connection, Movie.__tablename__)
+            with connection.begin():
+                sync_search_index(connection, Movie.__table__,
+                                  Movie.__table__.c.title,
+                                  after_id=next_movie - 1)
+            report('movies', nb_movies, started)
+            print(f'{nb_cast} cast members')
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Populate the database with fake Actors and Movies.')
+    parser.add_argument('database',
+                        help='environment variable holding the database URI '
+                             '(e.g. DB_URI)')
+    parser.add_argument('--bulk', action='store_true',
+                        help='high-volume mode (chunked bulk inserts)')
+    parser.add_argument('--actors', type=int, default=100000,
+                        help='number of Actors to create in bulk mode')
+    parser.add_argument('--movies', type=int, default=10000,
+                        help='number of Movies to create in bulk mode')
+    parser.add_argument('--max-cast', type=int, default=5,
+                        help='maximum number of Actors per Movie')
+    parser.add_argument('--chunk-size', type=int, default=10000,
+                        help='rows generated and written per chunk')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes generating the rows')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
 if __name__ == '__main__':
-    print('Populating database with fake Actors...')
-    populate_actors()
-    print('Populating database with fake Movies...')
-    populate_movies()
+    args = parse_args()
+
+    app = Flask(__name__)
+    database_path = os.getenv(args.database)
+    setup_db(app, database_path)
+
+    if args.bulk:
+        with app.app_context():
+            populate_bulk(args.actors, args.movies, args.max_cast,
+                          args.chunk_size, args.workers, args.seed)
+    else:
+        print('Populating database with fake Actors...')
+        populate_actors()
+        print('Populating database with fake Movies...')
+        populate_movies()
     print('Done!')
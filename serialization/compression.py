@@ -0,0 +1,145 @@
+import os
+import re
+import zlib
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+'''
+Response compression
+    responses are compressed with the first encoding of
+    COMPRESSION_ENCODINGS (br, gzip; br requires the brotli package) that
+    the client accepts, by Accept-Encoding quality. It is skipped for
+    bodies under COMPRESSION_MIN_SIZE bytes, statuses without a body (304,
+    204), responses that already have a Content-Encoding or ask for
+    `Cache-Control: no-transform`, and types other than JSON, NDJSON and
+    text. Streamed responses (the exports) are compressed chunk by chunk,
+    each chunk flushed as it is produced
+
+    a compressed representation gets its own ETag (`"<etag>-gzip"`): the
+    suffix is removed from If-None-Match and If-Match before the routes
+    compare them, so conditional requests keep working whatever the
+    encoding. COMPRESSION_ENCODINGS= (empty) disables compression
+'''
+COMPRESSION_ENCODINGS = [
+    encoding.strip() for encoding in
+    os.getenv('COMPRESSION_ENCODINGS', 'br,gzip').split(',')
+    if encoding.strip() and (encoding.strip() != 'br' or brotli is not None)]
+COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', 1024))
+# gzip level (1-9) and brotli quality (0-11)
+COMPRESSION_LEVEL = int(os.getenv('COMPRESSION_LEVEL', 6))
+BROTLI_QUALITY = int(os.getenv('BROTLI_QUALITY', 4))
+COMPRESSIBLE_MIMETYPES = ['application/json', 'application/x-ndjson']
+
+ETAG_SUFFIX = re.compile(r'-(?:gzip|br)"')
+
+
+def compressor(encoding, level=COMPRESSION_LEVEL, quality=BROTLI_QUALITY):
+    # A stream with compress(data) and flush(end=False), returning bytes;
+    # flush() makes everything compressed so far decodable, flush(end=True)
+    # ends the stream
+    if encoding == 'br':
+        return BrotliCompressor(quality)
+    return GzipCompressor(level)
+
+
+class GzipCompressor:
+    def __init__(self, level):
+        # wbits 31: gzip header and trailer
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self, end=False):
+        return self._compressor.flush(
+            zlib.Z_FINISH if end else zlib.Z_SYNC_FLUSH)
+
+
+class BrotliCompressor:
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self, end=False):
+        if end:
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+def compress(data, encoding, level=COMPRESSION_LEVEL,
+             quality=BROTLI_QUALITY):
+    if encoding == 'br':
+        return brotli.compress(data, quality=quality)
+    stream = GzipCompressor(level)
+    return stream.compress(data) + stream.flush(end=True)
+
+
+def compress_chunks(chunks, encoding):
+    stream = compressor(encoding)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = stream.compress(chunk) + stream.flush()
+            if data:
+                yield data
+        yield stream.flush(end=True)
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def is_compressible(response):
+    if response.status_code < 200 or response.status_code in [204, 304]:
+        return False
+    if response.direct_passthrough or 'Content-Encoding' in response.headers:
+        return False
+    if response.cache_control.no_transform:
+        return False
+    mimetype = response.mimetype or ''
+    return mimetype in COMPRESSIBLE_MIMETYPES or mimetype.startswith('text/')
+
+
+def init_compression(app, encodings=COMPRESSION_ENCODINGS,
+                     min_size=COMPRESSION_MIN_SIZE):
+    if not encodings:
+        return
+
+    @app.before_request
+    def strip_etag_encoding():
+        # Before request.if_none_match / if_match are parsed
+        for header in ['HTTP_IF_NONE_MATCH', 'HTTP_IF_MATCH']:
+            value = request.environ.get(header)
+            if value:
+                request.environ[header] = ETAG_SUFFIX.sub('"', value)
+
+    @app.after_request
+    def compress_response(response):
+        if not is_compressible(response):
+            return response
+        response.vary.add('Accept-Encoding')
+
+        encoding = request.accept_encodings.best_match(encodings)
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = compress_chunks(response.response, encoding)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < min_size:
+                return response
+            response.set_data(compress(data, encoding))
+
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_etag(f'{etag}-{encoding}', weak)
+        return response
@@ -0,0 +1,61 @@
+import os
+from flask.json import JSONEncoder
+
+'''
+JSON encoders
+    the encoder class of the app (app.json_encoder) is used by jsonify and
+    flask.json.dumps, so every response, the export lines and the response
+    cache go through it. JSON_ENCODER selects:
+    - orjson (default): encodes with orjson, without pretty-printing
+    - stdlib: Flask's encoder, on the json module
+
+    dates are ISO 8601 ('2020-05-17'); JSON_DATE_FORMAT=http restores the
+    HTTP dates of the original API ('Sun, 17 May 2020 00:00:00 GMT')
+'''
+JSON_ENCODERS = ['orjson', 'stdlib']
+DATE_FORMATS = ['iso', 'http']
+
+
+class IsoDateJSONEncoder(JSONEncoder):
+    def default(self, o):
+        if hasattr(o, 'isoformat'):
+            return o.isoformat()
+        return super().default(o)
+
+
+def orjson_encoder(date_format='iso'):
+    import orjson
+
+    options = orjson.OPT_NON_STR_KEYS
+    if date_format == 'http':
+        # Hand dates over to JSONEncoder.default, which formats HTTP dates
+        options |= orjson.OPT_PASSTHROUGH_DATETIME
+
+    class OrjsonEncoder(JSONEncoder):
+        def encode(self, o):
+            flags = options
+            if self.sort_keys:
+                flags |= orjson.OPT_SORT_KEYS
+            return orjson.dumps(o, default=self.default,
+                                option=flags).decode('utf-8')
+
+        def iterencode(self, o, _one_shot=False):
+            yield self.encode(o)
+
+    return OrjsonEncoder
+
+
+def encoder_from_env():
+    name = os.getenv('JSON_ENCODER', 'orjson')
+    date_format = os.getenv('JSON_DATE_FORMAT', 'iso')
+    if name not in JSON_ENCODERS:
+        raise ValueError(f'Unknown JSON_ENCODER: {name}')
+    if date_format not in DATE_FORMATS:
+        raise ValueError(f'Unknown JSON_DATE_FORMAT: {date_format}')
+
+    if name == 'stdlib':
+        if date_format == 'iso':
+            return IsoDateJSONEncoder
+        return JSONEncoder
+    return orjson_encoder(date_format)
+
@@ -1,11 +1,39 @@
 import os
+import shutil
+import tempfile
 import unittest
 import json
+import gzip
+import marshal
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from flask import Flask, Response, jsonify, request
+from flask.json import JSONEncoder as FlaskJSONEncoder
 from flask_sqlalchemy import SQLAlchemy
+from prometheus_client import REGISTRY
+from sqlalchemy import create_engine, event, exc, func, select, text
 from datetime import date
+import rsa
+from jose.utils import base64url_encode, long_to_bytes
 
-from app import create_app
-from models.models import setup_db, Movie, Actor
+from app import create_app, encode_cursor
+from models.models import setup_db, db, movies_actors, get_row_count, \
+    reconcile_row_counts, row_counts, Movie, Actor
+from populator import populate_bulk
+from auth.jwks import JWKSKeyStore
+from auth.token_cache import TokenCache
+from models.pool import PoolStats, TimedQueuePool, pool_stats
+from models.costars import CoStarIndex, costars_sql, shortest_path_sql
+from metrics.metrics import init_metrics
+from metrics.profiling import RequestProfile
+from admission.admission import AdmissionLimiter, Overloaded, init_admission
+from serialization.encoders import orjson_encoder
+from serialization.compression import init_compression
+from cache.cache import LRUBackend, RedisBackend, ResponseCache, \
+    movie_key, actor_key, response_cache
 
 
 class MovieTestCase(unittest.TestCase):
@@ -43,6 +71,162 @@ class MovieTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertEqual(len(data['movies']), 10)
 
+    def test_get_movies_statements_do_not_grow_with_casts(self):
+        headers = {
+            "Authorization": "Bearer {}".format(self.casting_assistant)
+        }
+        statements = []
+
+        def count_statement(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', count_statement)
+        try:
+            counts = {}
+            for path in ['/movies?limit=2', '/movies?limit=10', '/movies',
+                         '/movies/16']:
+                response_cache.clear()
+                statements.clear()
+                res = self.client().get(path, headers=headers)
+                self.assertEqual(res.status_code, 200)
+                counts[path] = len(statements)
+        finally:
+            event.remove(engine, 'before_cursor_execute', count_statement)
+
+        # The casts are loaded with one query per page, not one per Movie
+        self.assertEqual(counts['/movies?limit=2'],
+                         counts['/movies?limit=10'])
+        self.assertLessEqual(counts['/movies'], 3)
+        self.assertLessEqual(counts['/movies/16'], 2)
+
+    def test_get_movies_cursor_pagination(self):
+        headers = {
+            "Authorization": "Bearer {}".format(self.casting_assistant)
+        }
+        res = self.client().get('/movies?limit=5', headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['movies']), 5)
+        self.assertIsNotNone(data['next_cursor'])
+
+        res = self.client().get('/movies?limit=5&after={}'.format(
+            data['next_cursor']), headers=headers)
+        next_page = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertGreater(next_page['movies'][0]['id'],
+                           data['movies'][-1]['id'])
+
+    def test_400_get_movies_malformed_cursor(self):
+        headers = {
+            "Authorization": "Bearer {}".format(self.casting_assistant)
+        }
+        # [{}], ["1"] as the id, and [1, 1] as a (title, id) cursor
+        for query in ['after=W3t9XQ', 'after=WyIxIl0',
+                      'sort=title&after=WzEsMV0']:
+            res = self.client().get('/movies?' + query, headers=headers)
+
+            self.assertEqual(res.status_code, 400)
+
+    def test_get_movies_last_page_revalidated_after_append(self):
+        headers = {
+            "Authorization": "Bearer {}".format(self.executive_producer)
+        }
+        res = self.client().get('/movies?sort=-id&limit=2', headers=headers)
+        before_last = json.loads(res.data)['movies'][1]['id']
+        # A full last page: the last Movie, and no next_cursor
+        url = '/movies?limit=1&after={}'.format(
+            encode_cursor([before_last]))
+        res = self.client().get(url, headers=headers)
+        self.assertIsNone(json.loads(res.data)['next_cursor'])
+        etag = res.headers['ETag']
+
+        self.client().post('/movies', headers=headers, json={
+            'title': 'Appended Movie', 'release_date': '2020-01-01'})
+        headers['If-None-Match'] = etag
+        res = self.client().get(url, headers=headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIsNotNone(json.loads(res.data)['next_cursor'])
+
+    def test_get_movies_sparse_fieldset(self):
+        res = self.client().get('/movies?fields=id,title',
+                                headers={
+                                    "Authorization": "Bearer {}".format(
+                                        self.casting_assistant)
+                                })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(set(data['movies'][0]), {'id', 'title'})
+
+        res = self.client().get('/movies?fields=budget',
+                                headers={
+                                    "Authorization": "Bearer {}".format(
+                                        self.casting_assistant)
+                                })
+        self.assertEqual(res.status_code, 400)
+
+    def test_get_movies_batch_in_request_order(self):
+        res = self.client().get('/movies?ids=3,1,999999',
+                                headers={
+                                    "Authorization": "Bearer {}".format(
+                                        self.casting_assistant)
+                                })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([movie['id'] for movie in data['movies']], [3, 1])
+        self.assertEqual(data['missing'], [999999])
+
+    def test_get_movies_invalid_cursor(self):
+        res = self.client().get('/movies?after=not-a-cursor',
+                                headers={
+                                    "Authorization": "Bearer {}".format(
+                                        self.casting_assistant)
+                                })
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_export_movies_ndjson(self):
+        res = self.client().get('/movies/export',
+                                headers={
+                                    "Authorization": "Bearer {}".format(
+                                        self.casting_assistant)
+                                })
+        lines = res.data.decode('utf-8').splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertIn('actors', json.loads(lines[0]))
+
+    def test_search_finds_new_movie(self):
+        headers = {
+            "Authorization": "Bearer {}".format(self.executive_producer)
+        }
+        self.client().post('/movies', headers=headers,
+                           json={'title': 'Searchable Quokka',
+                                 'release_date': '2020-01-01'})
+
+        res = self.client().get('/search?q=quokka', headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('Searchable Quokka',
+                      [movie['title'] for movie in data['movies']])
+
+    def test_search_without_query(self):
+        res = self.client().get('/search',
+                                headers={
+                                    "Authorization": "Bearer {}".format(
+                                        self.casting_assistant)
+                                })
+
+        self.assertEqual(res.status_code, 400)
+
     def test_get_single_movie_successful(self):
         res = self.client().get('/movies/6',
                                 headers={
@@ -55,6 +239,94 @@ class MovieTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertEqual((data['movie']['id']), 6)
 
+    def test_get_movie_cast_paginated(self):
+        headers = {"Authorization": "Bearer {}".format(self.casting_director)}
+        self.client().post('/movies/16/actors', headers=headers,
+                           json={'actors': [1, 2, 3]})
+
+        res = self.client().get('/movies/16/actors?limit=2', headers=headers)
+        data = json.loads(res.data)
+        res = self.client().get(
+            '/movies/16/actors?limit=2&after=' + data['next_cursor'],
+            headers=headers)
+        ids = [actor['id'] for actor in data['actors']] + \
+            [actor['id'] for actor in json.loads(res.data)['actors']]
+
+        self.assertEqual(res.status_code, 200)
+        # In id order, without overlap between the pages
+        self.assertEqual(ids, sorted(set(ids)))
+
+    def test_get_movie_cast_last_page_revalidated_after_append(self):
+        headers = {"Authorization": "Bearer {}".format(self.casting_director)}
+        self.client().post('/movies/16/actors', headers=headers,
+                           json={'actors': [1, 2]})
+        res = self.client().get('/movies/16/actors?limit=100',
+                                headers=headers)
+        before_last = json.loads(res.data)['actors'][-2]['id']
+        # A full last page: the last Actor of the cast, and no next_cursor
+        url = '/movies/16/actors?limit=1&after={}'.format(
+            encode_cursor([before_last]))
+        res = self.client().get(url, headers=headers)
+        self.assertIsNone(json.loads(res.data)['next_cursor'])
+        etag = res.headers['ETag']
+
+        res = self.client().post('/actors', headers=headers, json={
+            'name': 'Appended Actor', 'age': 30, 'gender': 'female'})
+        actor_id = json.loads(res.data)['created']
+        self.client().post('/movies/16/actors', headers=headers,
+                           json={'actors': [actor_id]})
+        headers['If-None-Match'] = etag
+        res = self.client().get(url, headers=headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIsNotNone(json.loads(res.data)['next_cursor'])
+
+    def test_get_single_movie_embed_limit(self):
+        res = self.client().get('/movies/16?embed_limit=1',
+                                headers={
+                                    "Authorization": "Bearer {}".format(
+                                        self.casting_assistant)
+                                })
+        movie = json.loads(res.data)['movie']
+
+        self.assertEqual(res.status_code, 200)
+        self.assertLessEqual(len(movie['actors']), 1)
+        self.assertIn('actors_next_cursor', movie)
+
+    def test_400_get_single_movie_embed_limit_zero(self):
+        res = self.client().get('/movies/16?embed_limit=0',
+                                headers={
+                                    "Authorization": "Bearer {}".format(
+                                        self.casting_assistant)
+                                })
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_get_single_movie_not_modified(self):
+        headers = {
+            "Authorization": "Bearer {}".format(self.casting_director)
+        }
+        res = self.client().get('/movies/6', headers=headers)
+        etag = res.headers['ETag']
+
+        headers['If-None-Match'] = etag
+        res = self.client().get('/movies/6', headers=headers)
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers['ETag'], etag)
+        self.assertEqual(res.data, b'')
+
+    def test_patch_movie_precondition_failed(self):
+        res = self.client().patch('/movies/16',
+                                  headers={
+                                      "Authorization": "Bearer {}".format(
+                                          self.casting_director),
+                                      "If-Match": '"stale"'
+                                  },
+                                  json={'title': 'Edited title'})
+
+        self.assertEqual(res.status_code, 412)
+
     def test_get_single_movie_error_404(self):
         res = self.client().get('/movies/61993',
                                 headers={
@@ -98,6 +370,83 @@ class MovieTestCase(unittest.TestCase):
 
         self.assertEqual(res.status_code, 401)
 
+    def test_post_movies_bulk_reports_row_errors(self):
+        info = [
+            {'title': 'Bulk Movie', 'release_date': '2020-01-01'},
+            {'title': 'Bulk Movie without date'}
+        ]
+
+        res = self.client().post('/movies/bulk',
+                                 headers={
+                                     "Authorization": "Bearer {}".format(
+                                         self.executive_producer)
+                                 },
+                                 json=info)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['written'], 1)
+        self.assertEqual(data['errors'][0]['index'], 1)
+
+    def test_post_movies_bulk_upsert_with_and_without_ids(self):
+        info = {
+            'movies': [
+                {'id': 900, 'title': 'Bulk Movie 900',
+                 'release_date': '2020-01-01'},
+                {'title': 'Bulk Movie without id',
+                 'release_date': '2020-01-02'},
+                {'id': 2 ** 31, 'title': 'Bulk Movie out of range',
+                 'release_date': '2020-01-03'}
+            ],
+            'upsert': True
+        }
+
+        res = self.client().post('/movies/bulk',
+                                 headers={
+                                     "Authorization": "Bearer {}".format(
+                                         self.executive_producer)
+                                 },
+                                 json=info)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['written'], 2)
+        self.assertEqual([error['index'] for error in data['errors']], [2])
+        # The row without an id got one past the explicit id
+        with self.app.app_context():
+            movie = Movie.query.filter(
+                Movie.title == 'Bulk Movie without id').first()
+        self.assertGreater(movie.id, 900)
+
+    def test_patch_movie_cast_with_string_ids(self):
+        headers = {
+            "Authorization": "Bearer {}".format(self.executive_producer)
+        }
+        res = self.client().get('/actors?limit=1', headers=headers)
+        actor_id = json.loads(res.data)['actors'][0]['id']
+
+        res = self.client().patch('/movies/14', headers=headers,
+                                  json={'actors': [str(actor_id)]})
+
+        self.assertEqual(res.status_code, 200)
+
+    def test_patch_movie_cast_invalidates_cached_movie(self):
+        headers = {
+            "Authorization": "Bearer {}".format(self.executive_producer)
+        }
+        res = self.client().get('/actors?limit=1', headers=headers)
+        actor = json.loads(res.data)['actors'][0]
+        # Cached by the first read
+        self.client().get('/movies/12', headers=headers)
+
+        res = self.client().patch('/movies/12', headers=headers,
+                                  json={'actors': [actor['id']]})
+        self.assertEqual(res.status_code, 200)
+        res = self.client().get('/movies/12', headers=headers)
+
+        self.assertEqual(json.loads(res.data)['movie']['actors'],
+                         [actor['name']])
+
     def test_patch_movie_successful(self):
         info = {
             'title': 'Edited title',
@@ -114,6 +463,31 @@ class MovieTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
 
+    def test_add_and_remove_movie_cast(self):
+        headers = {"Authorization": "Bearer {}".format(self.casting_director)}
+
+        res = self.client().post('/movies/16/actors', headers=headers,
+                                 json={'actors': [1, 2]})
+        self.assertEqual(res.status_code, 200)
+        # Adding an existing link is a no-op
+        res = self.client().post('/movies/16/actors', headers=headers,
+                                 json={'actors': [1]})
+        self.assertEqual(json.loads(res.data)['added'], 0)
+
+        res = self.client().delete('/movies/16/actors?ids=1,2',
+                                   headers=headers)
+        self.assertEqual(json.loads(res.data)['removed'], 2)
+
+    def test_add_unknown_actor_to_cast(self):
+        res = self.client().post('/movies/16/actors',
+                                 headers={
+                                     "Authorization": "Bearer {}".format(
+                                         self.casting_director)
+                                 },
+                                 json={'actors': [99999999]})
+
+        self.assertEqual(res.status_code, 400)
+
     def test_patch_movie_error_404(self):
         info = {
             'title': 'Edited title',
@@ -130,15 +504,15 @@ class MovieTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 404)
 
     def test_delete_movie_successful(self):
-    res = self.client().delete('/movies/17',
-                               headers={
-                                   "Authorization": "Bearer {}".format(
-                                       self.executive_producer)
-                               })
-    data = json.loads(res.data)
+        res = self.client().delete('/movies/17',
+                                   headers={
+                                       "Authorization": "Bearer {}".format(
+                                           self.executive_producer)
+                                   })
+        data = json.loads(res.data)
 
-    self.assertEqual(res.status_code, 200)
-    self.assertEqual(data['success'], True)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
 
     def test_delete_movie_unauthorized(self):
         res = self.client().delete('/movies/5',
@@ -189,6 +563,38 @@ class ActorTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertEqual(len(data['actors']), 10)
 
+    def test_get_actors_last_page_revalidated_after_append(self):
+        headers = {
+            "Authorization": "Bearer {}".format(self.executive_producer)
+        }
+        res = self.client().get('/actors?sort=-id&limit=2', headers=headers)
+        before_last = json.loads(res.data)['actors'][1]['id']
+        # A full last page: the last Actor, and no next_cursor
+        url = '/actors?limit=1&after={}'.format(
+            encode_cursor([before_last]))
+        res = self.client().get(url, headers=headers)
+        self.assertIsNone(json.loads(res.data)['next_cursor'])
+        etag = res.headers['ETag']
+
+        self.client().post('/actors', headers=headers, json={
+            'name': 'Appended Actor', 'age': 30, 'gender': 'female'})
+        headers['If-None-Match'] = etag
+        res = self.client().get(url, headers=headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIsNotNone(json.loads(res.data)['next_cursor'])
+
+    def test_get_actors_limit_is_clamped(self):
+        res = self.client().get('/actors?limit=100000',
+                                headers={
+                                    "Authorization": "Bearer {}".format(
+                                        self.casting_director)
+                                })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertLessEqual(len(data['actors']), 100)
+
     def test_get_single_actor_successful(self):
         res = self.client().get('/actors/14',
                                 headers={
@@ -246,6 +652,18 @@ class ActorTestCase(unittest.TestCase):
 
         self.assertEqual(res.status_code, 401)
 
+    def test_post_actors_bulk_unauthorized(self):
+        info = [{'name': 'Brad Pitt', 'age': 50, 'gender': 'male'}]
+
+        res = self.client().post('/actors/bulk',
+                                 headers={
+                                     "Authorization": "Bearer {}".format(
+                                         self.casting_assistant)
+                                 },
+                                 json=info)
+
+        self.assertEqual(res.status_code, 401)
+
     def test_patch_actor_successful(self):
         info = {
             'name': 'Brad Pitt',
@@ -263,6 +681,26 @@ class ActorTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
 
+    def test_patch_actor_invalidates_cached_movie(self):
+        headers = {
+            "Authorization": "Bearer {}".format(self.executive_producer)
+        }
+        res = self.client().get('/actors?limit=1', headers=headers)
+        actor_id = json.loads(res.data)['actors'][0]['id']
+        self.client().patch('/movies/13', headers=headers,
+                            json={'actors': [actor_id]})
+        # Cached by the first read
+        self.client().get('/movies/13', headers=headers)
+
+        res = self.client().patch('/actors/{}'.format(actor_id),
+                                  headers=headers,
+                                  json={'name': 'Renamed Actor'})
+        self.assertEqual(res.status_code, 200)
+        res = self.client().get('/movies/13', headers=headers)
+
+        self.assertEqual(json.loads(res.data)['movie']['actors'],
+                         ['Renamed Actor'])
+
     def test_delete_actor_successful(self):
         res = self.client().delete('/actors/15',
                                    headers={
@@ -285,6 +723,699 @@ class ActorTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 401)
 
 
+class QueryPlanTestCase(unittest.TestCase):
+    """Check that list filters and sorts are served by an index."""
+
+    # Rows added (and rolled back) before the EXPLAIN: on the few rows of
+    # the test tables, the planner rightly prefers sequential scans
+    PLAN_ROWS = 50000
+    PLAN_ROWS_SQL = [
+        "INSERT INTO movies (title, release_date, version) "
+        "SELECT 'Plan movie ' || n, DATE '1950-01-01' + n % 25000, 1 "
+        "FROM generate_series(1, :rows) AS n",
+        "INSERT INTO actors (name, age, gender, version) "
+        "SELECT 'Plan actor ' || n, 18 + n % 70, "
+        "CASE WHEN n % 2 = 0 THEN 'female' ELSE 'male' END, 1 "
+        "FROM generate_series(1, :rows) AS n",
+        "INSERT INTO movies_actors (movie_id, actor_id) "
+        "SELECT movies.id, actors.id FROM movies JOIN actors "
+        "ON actors.name = 'Plan actor ' || substr(movies.title, 12) "
+        "WHERE movies.title LIKE 'Plan movie %'"
+    ]
+
+    def setUp(self):
+        self.app = create_app()
+        setup_db(self.app, os.getenv('DB_TEST_URI'))
+        self.casting_assistant = os.getenv('TOKEN_CASTING_ASSISTANT')
+
+    def route_query(self, url):
+        # The page query the route runs, with its parameters
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, *args):
+            statements.append((statement, parameters))
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', capture)
+        try:
+            res = self.app.test_client().get(url, headers={
+                "Authorization": "Bearer {}".format(self.casting_assistant)
+            })
+        finally:
+            event.remove(engine, 'before_cursor_execute', capture)
+
+        self.assertEqual(res.status_code, 200)
+        return next((statement, parameters)
+                    for statement, parameters in statements
+                    if 'ORDER BY' in statement and 'LIMIT' in statement)
+
+    def explain(self, url):
+        statement, parameters = self.route_query(url)
+        with self.app.app_context():
+            with db.engine.connect() as connection:
+                transaction = connection.begin()
+                try:
+                    for insert in self.PLAN_ROWS_SQL:
+                        connection.execute(text(insert),
+                                           rows=self.PLAN_ROWS)
+                    for table_name in ['movies', 'actors', 'movies_actors']:
+                        connection.execute('ANALYZE ' + table_name)
+                    return '\n'.join(row[0] for row in connection.execute(
+                        'EXPLAIN ' + statement, parameters))
+                finally:
+                    transaction.rollback()
+
+    def test_movies_sorted_by_title(self):
+        plan = self.explain('/movies?sort=title')
+        self.assertIn('ix_movies_title_id', plan)
+
+    def test_movies_release_date_range(self):
+        plan = self.explain(
+            '/movies?release_date_from=2000-01-01&release_date_to=2005-01-01'
+            '&sort=-release_date&limit=10')
+        self.assertIn('ix_movies_release_date_id', plan)
+
+    def test_actors_age_range(self):
+        plan = self.explain('/actors?min_age=30&max_age=40&sort=age')
+        self.assertIn('ix_actors_age_id', plan)
+
+    def test_actors_by_gender(self):
+        plan = self.explain('/actors?gender=female&limit=10')
+        self.assertIn('ix_actors_gender_id', plan)
+
+    def test_cast_lookup_by_movie(self):
+        plan = self.explain('/movies/3/actors')
+        self.assertIn('ix_movies_actors_movie_id', plan)
+
+
+class RowCountTestCase(unittest.TestCase):
+    """Check that the row counters follow the inserts and deletes."""
+
+    def setUp(self):
+        self.app = create_app()
+        setup_db(self.app, os.getenv('DB_TEST_URI'))
+
+    def test_counter_follows_insert_and_delete(self):
+        with self.app.app_context():
+            reconcile_row_counts()
+            before = get_row_count('movies')
+
+            movie = Movie(title='Counted', release_date=date(2001, 1, 1))
+            movie.insert()
+            self.assertEqual(get_row_count('movies'), before + 1)
+
+            movie.delete()
+            self.assertEqual(get_row_count('movies'), before)
+            self.assertEqual(get_row_count('movies'), Movie.query.count())
+
+    def test_reconcile_repairs_drift(self):
+        with self.app.app_context():
+            db.session.execute(row_counts.update().where(
+                row_counts.c.table_name == 'actors').values(count=-1))
+            db.session.commit()
+
+            drift = reconcile_row_counts(['actors'])
+            self.assertEqual(drift['actors'][0], -1)
+            self.assertEqual(get_row_count('actors'), Actor.query.count())
+
+
+class PopulatorTestCase(unittest.TestCase):
+    """Populate a SQLite database in high-volume mode."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.app = Flask(__name__)
+        setup_db(self.app, 'sqlite:///{}'.format(
+            os.path.join(self.directory, 'populated.db')))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_bulk_mode_writes_the_requested_rows(self):
+        with self.app.app_context():
+            # Several chunks of 7 rows
+            populate_bulk(30, 12, max_cast=3, chunk_size=7, workers=1,
+                          seed=0)
+
+            self.assertEqual(Actor.query.count(), 30)
+            self.assertEqual(Movie.query.count(), 12)
+            self.assertEqual(get_row_count('actors'), 30)
+            self.assertEqual(get_row_count('movies'), 12)
+            casts = db.session.execute(
+                select([movies_actors.c.movie_id, func.count()])
+                .group_by(movies_actors.c.movie_id)).fetchall()
+            self.assertEqual(len(casts), 12)
+            self.assertTrue(all(1 <= size <= 3 for _, size in casts))
+
+    def test_bulk_mode_casts_existing_actors(self):
+        with self.app.app_context():
+            populate_bulk(10, 0, max_cast=3, chunk_size=7, workers=1,
+                          seed=0)
+            # Gaps in the Actor IDs
+            db.session.execute(Actor.__table__.delete().where(
+                Actor.id.in_([2, 3, 5, 8])))
+            db.session.commit()
+            populate_bulk(0, 12, max_cast=3, chunk_size=7, workers=1,
+                          seed=0)
+
+            cast_ids = {actor_id for actor_id, in db.session.execute(
+                select([movies_actors.c.actor_id]))}
+            self.assertTrue(cast_ids)
+            self.assertLessEqual(cast_ids, {1, 4, 6, 7, 9, 10})
+
+
+class CoStarIndexTestCase(unittest.TestCase):
+    """Check the co-star index against the SQL fallback."""
+
+    def setUp(self):
+        # Movie m casts Actors m to m + 2: a chain of Actors
+        self.pairs = [(actor_id, movie_id) for movie_id in range(1, 21)
+                      for actor_id in range(movie_id, movie_id + 3)]
+        self.engine = create_engine('sqlite://')
+        db.metadata.create_all(self.engine, tables=[
+            Movie.__table__, Actor.__table__, movies_actors])
+        self.engine.execute(movies_actors.insert(), [
+            {'actor_id': actor_id, 'movie_id': movie_id}
+            for actor_id, movie_id in self.pairs])
+        self.index = CoStarIndex()
+        self.index.load(self.engine)
+
+    def test_index_matches_sql(self):
+        connection = self.engine.connect()
+        for source in [1, 5, 22]:
+            self.assertEqual(self.index.costars(source),
+                             costars_sql(connection, source))
+            for target in [1, 2, 9, 22]:
+                path = self.index.shortest_path(source, target, 6)
+                fallback = shortest_path_sql(connection, source, target, 6)
+                self.assertEqual(path and len(path[1]),
+                                 fallback and len(fallback[1]))
+        connection.close()
+
+    def test_path_links_actors_through_movies(self):
+        actors, movies = self.index.shortest_path(1, 9)
+        self.assertEqual((actors[0], actors[-1], len(movies)), (1, 9, 4))
+        for index, movie_id in enumerate(movies):
+            self.assertIn(movie_id, self.index.movies_of(actors[index]))
+            self.assertIn(movie_id, self.index.movies_of(actors[index + 1]))
+        self.assertIsNone(self.index.shortest_path(1, 22, max_depth=3))
+
+    def test_incremental_updates_and_compaction(self):
+        self.index.set_cast(1, [1, 22])
+        self.assertEqual(self.index.shortest_path(1, 22), ([1, 22], [1]))
+        self.index.remove_actor(22)
+        self.assertNotIn(22, self.index.costars(21))
+        self.assertEqual(sorted(self.index.actors_of(1)), [1])
+
+        self.index.movies = self.index.movies.compacted()
+        self.index.actors = self.index.actors.compacted()
+        self.assertEqual(self.index.movies.overlay_size, 0)
+        self.assertEqual(sorted(self.index.movies_of(20)), [18, 19, 20])
+        self.assertEqual(list(self.index.movies_of(22)), [])
+
+    def test_stale_index_is_rebuilt_in_background(self):
+        now = [0]
+        index = CoStarIndex(ttl=10, clock=lambda: now[0])
+        index.load(self.engine)
+        # The snapshot of a scan that started before the write below (an
+        # in-memory database is not shared with the rebuild thread)
+        snapshot = index._scan(self.engine)
+        scanned = threading.Event()
+        resume = threading.Event()
+
+        def slow_scan(engine):
+            scanned.set()
+            resume.wait(5)
+            return snapshot
+
+        index._scan = slow_scan
+        now[0] = 10
+        index.refresh(self.engine)
+        self.assertTrue(scanned.wait(5))
+        # The previous arrays keep serving, and a write the scan missed...
+        self.assertEqual(sorted(index.actors_of(1)), [1, 2, 3])
+        index.set_cast(1, [1, 22])
+        resume.set()
+        while index.built_at != 10:
+            time.sleep(0.001)
+
+        # ...is replayed on the rebuilt ones
+        self.assertEqual(index.costars(22)[1], 1)
+        self.assertEqual(sorted(index.actors_of(1)), [1, 22])
+
+
+class JWKSKeyStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        """Build a JWKS from a local RSA key and a counting source."""
+        public_key, _ = rsa.newkeys(512)
+        self.jwks = {'keys': [{
+            'kty': 'RSA',
+            'kid': 'test-key',
+            'use': 'sig',
+            'n': base64url_encode(
+                long_to_bytes(public_key.n)).decode('utf-8'),
+            'e': base64url_encode(
+                long_to_bytes(public_key.e)).decode('utf-8')
+        }]}
+        self.fetches = 0
+        self.now = 0
+
+        def source():
+            self.fetches += 1
+            return self.jwks
+
+        self.store = JWKSKeyStore(source, ttl=60, stale_ttl=10,
+                                  min_refetch_interval=5,
+                                  clock=lambda: self.now)
+
+    def test_keys_are_cached_until_ttl(self):
+        key = self.store.get_key('test-key')
+        self.assertIsNotNone(key)
+        self.now = 59
+        self.assertIs(self.store.get_key('test-key'), key)
+        self.assertEqual(self.fetches, 1)
+
+    def test_expired_keys_are_refetched(self):
+        self.store.get_key('test-key')
+        self.now = 100
+        self.store.get_key('test-key')
+        self.assertEqual(self.fetches, 2)
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        self.store.get_key('test-key')
+        self.now = 10
+        self.assertIsNone(self.store.get_key('rotated-key'))
+        self.assertIsNone(self.store.get_key('rotated-key'))
+        self.assertEqual(self.fetches, 2)
+
+    def test_failing_source_keeps_last_keys(self):
+        key = self.store.get_key('test-key')
+        self.jwks = None
+        self.now = 100
+        self.assertIs(self.store.get_key('test-key'), key)
+        self.assertEqual(self.store.fetch_errors, 1)
+
+
+class TokenCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000
+        self.cache = TokenCache(max_size=2, ttl=60, clock=lambda: self.now)
+        self.payload = {'exp': 1030, 'permissions': ['get:movies']}
+
+    def test_cached_payload_until_expiry(self):
+        self.assertIsNone(self.cache.get('token'))
+        self.cache.put('token', self.payload)
+        payload = self.cache.get('token')
+        self.assertEqual(payload['permissions'], frozenset(['get:movies']))
+        self.now = 1030
+        self.assertIsNone(self.cache.get('token'))
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache.put('a', self.payload)
+        self.cache.put('b', self.payload)
+        self.cache.get('a')
+        self.cache.put('c', self.payload)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertIsNotNone(self.cache.get('a'))
+
+    def test_invalidate(self):
+        self.cache.put('token', self.payload)
+        self.assertTrue(self.cache.invalidate('token'))
+        self.assertIsNone(self.cache.get('token'))
+
+
+class FakeRedis:
+    """Local stand-in for a Redis client."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def incr(self, key):
+        self.data[key] = int(self.data.get(key, 0)) + 1
+        return self.data[key]
+
+    def expire(self, key, seconds):
+        pass
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+
+    def test_lru_backend_size_and_ttl(self):
+        now = [0]
+        backend = LRUBackend(max_size=2, ttl=10, clock=lambda: now[0])
+        backend.set('a', b'1')
+        backend.set('b', b'2')
+        backend.get('a')
+        backend.set('c', b'3')
+        self.assertIsNone(backend.get('b'))
+        self.assertEqual(backend.get('a'), b'1')
+        now[0] = 10
+        self.assertIsNone(backend.get('a'))
+
+    def test_redis_backend_round_trip_and_invalidation(self):
+        client = FakeRedis()
+        cache = ResponseCache(RedisBackend(client))
+        cache.set(movie_key(1), '"etag"', b'{"success": true}')
+
+        self.assertEqual(cache.get(movie_key(1)),
+                         ('"etag"', b'{"success": true}'))
+        cache.invalidate(movie_key(1), actor_key(2))
+        self.assertIsNone(cache.get(movie_key(1)))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_fill_after_invalidation_is_dropped(self):
+        for backend in [LRUBackend(), RedisBackend(FakeRedis())]:
+            cache = ResponseCache(backend)
+            # A reader misses, then loads the row while a write invalidates
+            generation = cache.generation(movie_key(1))
+            cache.invalidate(movie_key(1))
+            cache.set(movie_key(1), '"stale"', b'{}', generation)
+            self.assertIsNone(cache.get(movie_key(1)))
+
+            # A fill that started after the invalidation is kept
+            generation = cache.generation(movie_key(1))
+            cache.set(movie_key(1), '"fresh"', b'{}', generation)
+            self.assertEqual(cache.get(movie_key(1)), ('"fresh"', b'{}'))
+
+    def test_backend_errors_are_misses(self):
+        cache = ResponseCache(RedisBackend(None))
+        self.assertIsNone(cache.get(movie_key(1)))
+        self.assertEqual(cache.errors, 1)
+
+
+class PoolStatsTestCase(unittest.TestCase):
+
+    def test_wait_histogram_is_cumulative(self):
+        stats = PoolStats(buckets=[0.01, 0.1])
+        for wait in [0.001, 0.05, 0.05, 2]:
+            stats.observe_checkout(wait)
+        stats.observe_checkin()
+
+        histogram = stats.histogram()
+        self.assertEqual(histogram['buckets'],
+                         [[0.01, 1], [0.1, 3], ['+Inf', 4]])
+        self.assertEqual(histogram['count'], 4)
+        self.assertEqual(stats.checked_out, 3)
+
+    def test_pool_timeouts_are_counted(self):
+        pool_stats.reset()
+        pool = TimedQueuePool(lambda: sqlite3.connect(':memory:'),
+                              pool_size=1, max_overflow=0, timeout=0.01)
+        connection = pool.connect()
+        with self.assertRaises(exc.TimeoutError):
+            pool.connect()
+        connection.close()
+
+        self.assertEqual(pool_stats.checkouts, 1)
+        self.assertEqual(pool_stats.timeouts, 1)
+        self.assertEqual(pool_stats.checked_out, 0)
+
+
+class AsyncAppTestCase(unittest.TestCase):
+    """Serve async_app with gevent, in its own (monkey patched) process."""
+
+    SERVE = '''
+import gevent
+from gevent import monkey
+from gevent.pywsgi import WSGIServer
+from urllib.request import urlopen
+import async_app
+
+server = WSGIServer(('127.0.0.1', 0), async_app.app, log=None)
+server.start()
+url = 'http://127.0.0.1:{}/'.format(server.server_port)
+requests = [gevent.spawn(lambda: urlopen(url, timeout=10).status)
+            for _ in range(20)]
+gevent.joinall(requests, timeout=30)
+print(monkey.is_module_patched('socket'),
+      sorted(set(request.value for request in requests)))
+'''
+
+    def test_concurrent_requests_are_served(self):
+        result = subprocess.run(
+            [sys.executable, '-c', self.SERVE],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=60)
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.decode().splitlines()[-1],
+                         'True [200]')
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    """Run one scenario of the offline benchmark on a SQLite database."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_scenario_runs_without_errors(self):
+        output = os.path.join(self.directory, 'results.json')
+        root = os.path.dirname(os.path.abspath(__file__))
+        result = subprocess.run(
+            [sys.executable, os.path.join(root, 'benchmarks', 'api.py'),
+             '--actors', '50', '--movies', '20', '--requests', '10',
+             '--warmup', '2', '--concurrency', '2', '--routes', 'get_movie',
+             '--output', output],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=120)
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        with open(output) as results_file:
+            route = json.load(results_file)['routes']['get_movie']
+        self.assertEqual(route['requests'], 10)
+        self.assertEqual(route['errors'], 0)
+
+
+class AdmissionTestCase(unittest.TestCase):
+
+    def test_limiter_queue_and_timeout(self):
+        limiter = AdmissionLimiter(1, queue_size=1, timeout=0.2)
+        self.assertEqual(limiter.acquire(), 0.0)
+
+        reasons = []
+
+        def wait_for_slot():
+            try:
+                limiter.acquire()
+            except Overloaded as error:
+                reasons.append(error.reason)
+
+        waiter = threading.Thread(target=wait_for_slot)
+        waiter.start()
+        while limiter.waiting == 0:
+            time.sleep(0.001)
+        # The queue is full: rejected at once
+        with self.assertRaises(Overloaded) as context:
+            limiter.acquire()
+        self.assertEqual(context.exception.reason, 'queue_full')
+
+        waiter.join()
+        self.assertEqual(reasons, ['timeout'])
+        limiter.release()
+        self.assertEqual(limiter.active, 0)
+
+    def test_waiter_gets_released_slot(self):
+        limiter = AdmissionLimiter(1, queue_size=1, timeout=5)
+        limiter.acquire()
+        waited = []
+        waiter = threading.Thread(target=lambda: waited.append(
+            limiter.acquire()))
+        waiter.start()
+        while limiter.waiting == 0:
+            time.sleep(0.001)
+        limiter.release()
+        waiter.join()
+
+        self.assertEqual(len(waited), 1)
+        self.assertEqual(limiter.active, 1)
+
+    def test_overloaded_class_is_shed(self):
+        app = Flask(__name__)
+        init_admission(app, {'health': None}, limiters={
+            'read': AdmissionLimiter(0), 'write': AdmissionLimiter(1)})
+        app.add_url_rule('/', 'index', lambda: 'ok', methods=['GET', 'POST'])
+        app.add_url_rule('/health', 'health', lambda: 'ok')
+        client = app.test_client()
+
+        res = client.get('/')
+        self.assertEqual(res.status_code, 503)
+        self.assertIn('Retry-After', res.headers)
+        # Other classes, and exempt routes, are still served
+        self.assertEqual(client.post('/').status_code, 200)
+        self.assertEqual(client.post('/').status_code, 200)
+        self.assertEqual(client.get('/health').status_code, 200)
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        """Serve a route running two SQL statements, with metrics."""
+        self.app = Flask(__name__)
+        self.engine = engine = create_engine('sqlite://')
+        init_metrics(self.app, engine)
+
+        @self.app.route('/items/<int:item_id>')
+        def get_item(item_id):
+            engine.execute('SELECT 1')
+            engine.execute('SELECT 2')
+            return jsonify({'id': item_id})
+
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_request_is_measured_per_route(self):
+        route = '/items/<int:item_id>'
+        requests = self.sample('http_request_duration_seconds_count',
+                               route=route, method='GET', status='200')
+        statements = self.sample('http_request_sql_statements_sum',
+                                 route=route)
+
+        res = self.app.test_client().get('/items/7')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            self.sample('http_request_duration_seconds_count',
+                        route=route, method='GET', status='200'),
+            requests + 1)
+        self.assertEqual(
+            self.sample('http_request_sql_statements_sum', route=route),
+            statements + 2)
+        self.assertGreater(
+            self.sample('http_request_serialization_seconds_count',
+                        route=route), 0)
+
+
+    def test_failed_statement_is_not_left_pending(self):
+        with self.engine.connect() as connection:
+            for _ in range(3):
+                with self.assertRaises(exc.OperationalError):
+                    connection.execute('SELECT * FROM missing')
+
+            self.assertFalse(connection.info.get('query_started'))
+
+
+class RequestProfileTestCase(unittest.TestCase):
+
+    def busy(self):
+        started = time.perf_counter()
+        while time.perf_counter() - started < 0.05:
+            sum(range(1000))
+
+    def test_collapsed_stacks_are_sampled(self):
+        profile = RequestProfile('collapsed')
+        profile.start()
+        self.busy()
+        profile.stop()
+
+        lines = profile.artifact().decode('utf-8').splitlines()
+        self.assertTrue(lines)
+        self.assertTrue(any('tests.py:busy' in line for line in lines))
+        stack, count = lines[0].rsplit(' ', 1)
+        self.assertGreater(int(count), 0)
+
+    def test_pstats_artifact_loads(self):
+        profile = RequestProfile('pstats')
+        profile.start()
+        self.busy()
+        profile.stop()
+
+        stats = marshal.loads(profile.artifact())
+        self.assertTrue(any(function == 'busy'
+                            for _, _, function in stats))
+
+
+class CompressionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        """Serve a large, a small and a streamed response, gzip only."""
+        self.app = Flask(__name__)
+        init_compression(self.app, encodings=['gzip'], min_size=100)
+        self.page = {'movies': ['Movie {}'.format(id)
+                                for id in range(100)]}
+
+        @self.app.route('/large')
+        def large():
+            if request.if_none_match.contains_weak('v1'):
+                return Response(status=304)
+            response = jsonify(self.page)
+            response.set_etag('v1')
+            return response
+
+        @self.app.route('/small')
+        def small():
+            return jsonify({'success': True})
+
+        @self.app.route('/stream')
+        def stream():
+            return Response((line + '\n' for line in ['{"a":1}'] * 3),
+                            mimetype='application/x-ndjson')
+
+        self.client = self.app.test_client()
+
+    def get(self, path, **headers):
+        return self.client.get(path, headers=dict(
+            {'Accept-Encoding': 'gzip'}, **headers))
+
+    def test_large_body_is_compressed(self):
+        res = self.get('/large')
+
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(res.data)), self.page)
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+
+    def test_small_or_unaccepted_is_not(self):
+        self.assertNotIn('Content-Encoding', self.get('/small').headers)
+        self.assertNotIn('Content-Encoding', self.client.get(
+            '/large').headers)
+
+    def test_stream_is_compressed(self):
+        res = self.get('/stream')
+
+        self.assertEqual(gzip.decompress(res.data), b'{"a":1}\n' * 3)
+
+    def test_encoded_etag_is_revalidated(self):
+        etag = self.get('/large').headers['ETag']
+        res = self.get('/large', **{'If-None-Match': etag})
+
+        self.assertEqual(etag, '"v1-gzip"')
+        self.assertEqual(res.status_code, 304)
+        self.assertNotIn('Content-Encoding', res.headers)
+
+
+class JSONEncoderTestCase(unittest.TestCase):
+
+    def encode(self, encoder, value):
+        return json.dumps(value, cls=encoder, separators=(',', ':'),
+                          sort_keys=True)
+
+    def test_orjson_dates_are_iso(self):
+        self.assertEqual(
+            self.encode(orjson_encoder('iso'),
+                        {'title': 'T', 'release_date': date(2020, 5, 17)}),
+            '{"release_date":"2020-05-17","title":"T"}')
+
+    def test_orjson_http_dates_match_flask(self):
+        value = {'release_date': date(2020, 5, 17), 'actors': ['A', 'B']}
+        self.assertEqual(self.encode(orjson_encoder('http'), value),
+                         self.encode(FlaskJSONEncoder, value))
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()